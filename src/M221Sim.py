@@ -0,0 +1,235 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        M221Sim.py
+#
+# Purpose:     This module provides a local Modbus TCP server emulating the
+#              Schneider M221 PLC %M coil map (M2PLC221.MEM_ADDR) so the M221
+#              client and <pwrGenMgr> can be tested and benchmarked without the
+#              physical PLCs. The read responses follow <m221_plc_modbus.txt>
+#              (8 data bytes for the 0x3d coils read). Per-request latency,
+#              jitter and fault injection can be configured.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/20
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import time
+import random
+import struct
+import threading
+import socketserver
+
+import plcComm
+import devDriver
+import M2PLC221 as m221
+
+# Coil images of the PLCs with all the loads off. <m221_plc_modbus.txt>
+S1_OFF_IMG = bytes.fromhex('0100004000000010')  # S1(192.168.10.72)
+S3_OFF_IMG = bytes.fromhex('3100000000000010')  # S3(192.168.10.71)
+COIL_SZ = 0x80  # number of emulated %M bits.
+
+# Fault modes used when a request is selected by the fault rate.
+FT_DROP = 'drop'    # don't response the request.
+FT_EXC = 'exc'      # response Modbus exception 04 (slave device failure).
+FT_CLOSE = 'close'  # close the connection.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class M221Sim(threading.Thread):
+    """ M221 stand-in server thread. Use port=0 to get a free port from the OS,
+        the bound port is saved in self.port.
+        init example: sim = M221Sim(None, coilImg=S1_OFF_IMG, latency=0.01)
+    """
+    def __init__(self, parent, host='127.0.0.1', port=0, coilImg=None,
+                 latency=0, jitter=0, faultRate=0, faultMode=FT_DROP, debug=False):
+        threading.Thread.__init__(self, daemon=True)
+        self.parent = parent
+        self.latency = latency      # fixed delay of each response (sec).
+        self.jitter = jitter        # random extra delay [0, jitter) (sec).
+        self.faultRate = faultRate  # probability of a request getting the fault.
+        self.faultMode = faultMode
+        self.debug = debug
+        self.coils = [0]*COIL_SZ
+        if coilImg: self.setImage(coilImg)
+        self.regs = [0]*COIL_SZ
+        self.lock = threading.Lock()
+        self.reqCount = 0           # number of handled requests.
+        self.faultCount = 0         # number of injected faults.
+        sim = self
+
+        class _handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                sim._serveClient(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((host, port), _handler)
+        self.server.daemon_threads = True
+        self.ip, self.port = self.server.server_address
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Start the Modbus TCP server loop."""
+        self.server.serve_forever()
+        self.server.server_close()
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the server."""
+        self.server.shutdown()
+
+#-----------------------------------------------------------------------------
+    def setImage(self, coilImg):
+        """ Load the coil state from the bytes image (LSB first as Modbus)."""
+        for i in range(min(len(coilImg)*8, COIL_SZ)):
+            self.coils[i] = (coilImg[i//8] >> (i % 8)) & 1
+
+#-----------------------------------------------------------------------------
+    def setCoil(self, mTag, val):
+        """ Script a coil change (e.g. a load switched on by the PLC program)."""
+        self.coils[m221.MEM_ADDR[mTag]] = int(val) & 1
+
+#-----------------------------------------------------------------------------
+    def getCoil(self, mTag):
+        """ Return the current coil value of the memory tag."""
+        return self.coils[m221.MEM_ADDR[mTag]]
+
+#-----------------------------------------------------------------------------
+    def _recvExact(self, conn, size):
+        """ Read exactly <size> bytes, return None if the client disconnected."""
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = conn.recv(size - len(buf))
+            if not chunk: return None
+            buf += chunk
+        return bytes(buf)
+
+#-----------------------------------------------------------------------------
+    def _serveClient(self, conn):
+        """ Handle the requests from one client connection. The requests are 
+            executed when received and each response is sent after its own
+            latency, so pipelined requests overlap like on a real network.
+        """
+        sendLock = threading.Lock()
+        def send(frame):
+            with sendLock:
+                try:
+                    conn.sendall(frame)
+                except OSError:
+                    pass    # client already closed.
+        while True:
+            header = self._recvExact(conn, m221.MBAP_HDR.size)
+            if header is None: return
+            tid, pid, length, uid = m221.MBAP_HDR.unpack(header)
+            pdu = self._recvExact(conn, length - 1)
+            if pdu is None: return
+            with self.lock:
+                self.reqCount += 1
+                fault = self.faultRate and random.random() < self.faultRate
+                if fault: self.faultCount += 1
+                body = bytes((pdu[0] | 0x80, 0x04)) if fault else self._handlePdu(pdu)
+            if fault and self.faultMode == FT_DROP: continue
+            if fault and self.faultMode == FT_CLOSE: return
+            if self.debug: print("M221Sim: %s -> %s" % (pdu.hex(), body.hex()))
+            frame = m221.MBAP_HDR.pack(tid, pid, len(body)+1, uid) + body
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                threading.Timer(delay, send, (frame,)).start()
+            else:
+                send(frame)
+
+#-----------------------------------------------------------------------------
+    def _handlePdu(self, pdu):
+        """ Execute the request PDU on the coil map and return the response PDU."""
+        fc = pdu[0]
+        if fc in (m221.M_RD, m221.R_RD):
+            _, start, count = m221.RD_REQ.unpack(pdu[:m221.RD_REQ.size])
+            if start + count > COIL_SZ: return bytes((fc | 0x80, 0x02))
+            if fc == m221.R_RD:
+                return bytes((fc, count*2)) + struct.pack('>%dH' % count, *self.regs[start:start+count])
+            data = bytearray((count + 7)//8)
+            for i in range(count):
+                if self.coils[start+i]: data[i//8] |= 1 << (i % 8)
+            return bytes((fc, len(data))) + bytes(data)
+        elif fc == m221.M_FC:
+            _, start, count, _ = m221.WR_REQ.unpack(pdu[:m221.WR_REQ.size])
+            if start + count > COIL_SZ: return bytes((fc | 0x80, 0x02))
+            values = pdu[m221.WR_REQ.size:]
+            for i in range(count):
+                self.coils[start+i] = (values[i//8] >> (i % 8)) & 1
+            return bytes((fc,)) + m221.WR_RSP.pack(start, count)
+        return bytes((fc | 0x80, 0x01))  # illegal function.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        print("Benchmark the M221 client with a 5ms latency simulator:")
+        sim = M221Sim(None, coilImg=S1_OFF_IMG, latency=0.005, jitter=0.001)
+        sim.start()
+        plc = m221.M221(sim.ip, port=sim.port)
+        bits = plc.readMem()
+        print("Airport: %s, Industry: %s" % (bits[m221.MEM_ADDR['M10']],
+                                             0 if bits[m221.MEM_ADDR['M60']] else 1))
+        for label, wait in (('stop-and-wait', True), ('pipelined', False)):
+            startT = time.monotonic()
+            results = [plc.readMem(wait=wait) for _ in range(100)]
+            if not wait: results = [ft.result() for ft in results]
+            print("%s: 100 reads in %.3f sec" % (label, time.monotonic() - startT))
+        plc.writeCoils({'M0': 1, 'M10': 1, 'M60': 0})
+        print("M10 after write: %s" % sim.getCoil('M10'))
+        plc.disconnect()
+        sim.stop()
+    elif mode == 1:
+        print("Fault injection test:")
+        sim = M221Sim(None, coilImg=S3_OFF_IMG, faultRate=0.5, faultMode=FT_EXC)
+        sim.start()
+        plc = m221.M221(sim.ip, port=sim.port)
+        for _ in range(5):
+            try:
+                print(plc.writeMem('M10', 1, force=True))   # bypass the shadow de-dup.
+            except m221.ModbusError as err:
+                print(err)
+        print("Requests: %s, faults: %s" % (sim.reqCount, sim.faultCount))
+        plc.disconnect()
+        sim.stop()
+    elif mode == 2:
+        print("Circuit breaker test with a PLC which accepts the connections but drops all the requests:")
+        sim = M221Sim(None, coilImg=S1_OFF_IMG, faultRate=1, faultMode=FT_DROP)
+        sim.start()
+        plcs = {'plc1': m221.M221(sim.ip, port=sim.port)}
+        breaker = plcComm.circuitBreaker('plc1')
+        actor = devDriver.devActor('plc1', lambda: plcs['plc1'], breaker=breaker,
+                                   probe=lambda plc: plc.readCoilBytes(0, 1) is not None)
+        actor.start()
+        # The reconnect manager keeps re-creating the dead PLC object.
+        reconnMgr = plcComm.reconnManager(None, ('plc1',), lambda name: plcs[name].connected,
+                                          lambda name: m221.M221(sim.ip, port=sim.port),
+                                          lambda name, plc: plcs.update({name: plc}))
+        reconnMgr.start()
+        slowCalls, states = 0, []
+        for _ in range(40):
+            startT = time.monotonic()
+            try:
+                actor.call('readCoilBytes', 0, 8, priority=devDriver.PRI_POLL)
+            except Exception:
+                pass
+            if time.monotonic() - startT > 0.1: slowCalls += 1
+            states.append(breaker.getState())
+            time.sleep(0.2)
+        # Only the first request and the half-open probe wait for the timeout.
+        print("breaker states: %s" % sorted(set(states)))
+        print("breaker stays open: %s, slow calls: %s/40 (expect <= 2)" 
+              % (plcComm.BR_CLOSED not in states[3:], slowCalls))
+        reconnMgr.stop()
+        actor.stop()
+        sim.stop()
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
@@ -14,106 +14,366 @@
 # Copyright:   NUS Singtel Cyber Security Research & Development Laboratory
 # License:     YC @ NUS
 #-----------------------------------------------------------------------------
+import time
 import socket
-import platform    # For getting the operating system name
-import subprocess  # For executing a shell command
-from platform import python_version
+import struct
+import threading
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
 
-# Check the python version, if < 3.6 use bytes.dencode('hex') to decode the 
-# PLC response data, eles use bytes.hex() decode.
-DECODE_MD = (float(python_version()[0:3]) < 3.6)
+import plcComm
 
 PLC_PORT = 502  # Mode bus TCP port.
 BUFF_SZ = 1024  # TCP buffer size.
 # M221 PLC memory address list.
-MEM_ADDR = {'M0':   '0000',
-            'M1':   '0001',
-            'M2':   '0002',
-            'M3':   '0003',
-            'M4':   '0004',
-            'M5':   '0005',
-            'M6':   '0006',
-            'M10':  '000a',
-            'M20':  '0014',
-            'M30':  '001e',
-            'M40':  '0028',
-            'M50':  '0032',
-            'M60':  '003c'
+MEM_ADDR = {'M0':   0x0000,
+            'M1':   0x0001,
+            'M2':   0x0002,
+            'M3':   0x0003,
+            'M4':   0x0004,
+            'M5':   0x0005,
+            'M6':   0x0006,
+            'M10':  0x000a,
+            'M20':  0x0014,
+            'M30':  0x001e,
+            'M40':  0x0028,
+            'M50':  0x0032,
+            'M60':  0x003c
            }
 
-TID = '0000'
-PROTOCOL_ID = '0000'
-UID = '01'
-BIT_COUNT = '0001'
-BYTE_COUNT = '01'
-W_LENGTH = '0008'   # write byte lenght
-R_LENGTH = '0006'   # read byte length
-M_FC = '0f' # memory access function code(write).
-M_RD = '01' # memory state fetch internal bits %M
-VALUES = {'0': '00', '1': '01'}
+PROTOCOL_ID = 0x0000
+UID = 0x01
+M_FC = 0x0f     # memory access function code(write multiple coils).
+M_RD = 0x01     # memory state fetch internal bits %M
+R_RD = 0x03     # holding register fetch %MW
+COIL_NUM = 0x3d # number of %M bits fetched by readMem().
+COIL_BYTES = (COIL_NUM + 7)//8  # coil data bytes of the readMem() response.
+MAX_INFLIGHT = 4 # default number of requests allowed in flight on one socket.
+RECV_POLL_DIV = 4   # the socket timeout is 1/RECV_POLL_DIV of the request deadline.
+
+# Pre-compiled Modbus TCP frame layouts (big endian).
+MBAP_HDR = struct.Struct('>HHHB')   # transaction ID, protocol ID, length, unit ID
+RD_REQ = struct.Struct('>BHH')      # function code, start address, quantity
+WR_REQ = struct.Struct('>BHHB')     # function code, start address, quantity, byte count
+WR_RSP = struct.Struct('>HH')       # echoed start address, quantity
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class ModbusError(plcComm.PlcProtocolError):
+    """ Raised when the PLC response is a Modbus exception or does not match 
+        the request.
+    """
+    pass
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 class M221(object):
-    def __init__(self, ip, debug=False):
+    """ Schneider M221 Modbus TCP client. Requests are pipelined: up to <window>
+        requests can be in flight on the socket, a receive thread matches the 
+        replies back to the requests by MBAP transaction ID. Each read/write API
+        blocks for the result by default, call it with wait=False to get the 
+        concurrent.futures.Future instead (a list of Futures for the writes).
+    """
+    def __init__(self, ip, debug=False, window=MAX_INFLIGHT, port=PLC_PORT,
+                 connTimeout=plcComm.CONN_TIMEOUT, ioTimeout=plcComm.IO_TIMEOUT):
         self.ip = ip
+        self.port = port
+        self.connTimeout = connTimeout  # connection establish deadline (sec).
+        self.ioTimeout = ioTimeout      # request deadline (sec).
         self.debug = debug
         self.connected = False
         self.plcAgent = None
-        if self._pingPLC(self.ip):
+        self.tid = 0    # Modbus transaction ID of the last request.
+        self.pending = {}   # in flight requests {tid: (future, function code, decoder, send time)}
+        self.pendLock = threading.Lock()
+        self.lostErr = None # error which ended the receive thread, fails the new requests.
+        self.sendLock = threading.Lock()
+        self.window = threading.BoundedSemaphore(window)
+        self.recvThread = None
+        self.shadow = plcComm.shadowImage(COIL_BYTES) # last confirmed %M bits.
+        if self._probePLC(self.ip):
             self.plcAgent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
-                self.plcAgent.connect((self.ip, 502))
+                self.plcAgent.settimeout(self.connTimeout)
+                self.plcAgent.connect((self.ip, self.port))
+                # Bound the sends, the receive thread wakes up to check the 
+                # request deadlines.
+                self.plcAgent.settimeout(self.ioTimeout/RECV_POLL_DIV)
                 self.connected = True
             except OSError as error:
                 print("M221: Can not access to the PLC [%s]" % str(self.plcAgent))
                 print(error)
+        if self.connected:
+            self.recvThread = threading.Thread(target=self._recvLoop, daemon=True)
+            self.recvThread.start()
 
 #-----------------------------------------------------------------------------
-    def _pingPLC(self, host):
-        """ Returns True if host (str) responds to a ping request. Remember that a host 
-            may not respond to a ping (ICMP) request even if the host name is valid.
+    def _probePLC(self, host):
+        """ Returns True if the PLC's Modbus port accepts a TCP connection in the
+            short probe deadline.
         """
-        # Option for the number of packets as a function of
-        param = '-n' if platform.system().lower()=='windows' else '-c'
-        # Building the command. Ex: "ping -c 1 google.com"
-        command = ['ping', param, '1', host]
-        return subprocess.call(command) == 0
+        return plcComm.tcpProbe(host, self.port)
 
 #-----------------------------------------------------------------------------
-    def readMem(self):
-        """ Fetch the current plc memory state."""
-        modbusMsg = TID + PROTOCOL_ID + R_LENGTH + UID + M_RD+'0000003d'
-        response = self._getRespStr(modbusMsg)
-        return str(response)
+    def readMem(self, wait=True):
+        """ Fetch the current plc memory state, return the %M bit list (index 
+            is the address in MEM_ADDR) or None if the PLC is not connected.
+        """
+        return self.readCoils(0, COIL_NUM, wait=wait)
 
 #-----------------------------------------------------------------------------
-    def writeMem(self, mTag, val):
-        """ Set the plc memory address. mTag: (str)memory tag, val:(int) 0/1"""
-        modbusMsg = TID + PROTOCOL_ID + W_LENGTH + UID + M_FC + \
-            MEM_ADDR[mTag] + BIT_COUNT + BYTE_COUNT + VALUES[str(val)]
-        response = self._getRespStr(modbusMsg)
-        return str(response)
+    def readCoils(self, start, count, wait=True):
+        """ Read <count> internal bits from address <start>, return a list of 
+            int 0/1.
+        """
+        def decoder(data):
+            if len(data) < 1 or data[0] != (count + 7)//8:
+                raise ModbusError("M221: coil byte count mismatch %s" % data.hex())
+            bits = [(data[1 + i//8] >> (i % 8)) & 1 for i in range(count)]
+            if start % 8 == 0:
+                self.shadow.setBytes(start//8, data[1:])
+            else:
+                self.shadow.setBits(start, bits)
+            return bits
+        return self._request(RD_REQ.pack(M_RD, start, count), decoder, wait)
 
 #-----------------------------------------------------------------------------
-    def _getRespStr(self, modbusMsg):
-        """ Convert the sendStr to hex byte and send to PLC. Wait for PLC's 
-            response and convert the response hex bytes to string.
+    def readCoilBytes(self, start, count, wait=True):
+        """ Read <count> internal bits from address <start>, return the raw coil
+            data bytes (LSB first, without the byte count).
         """
-        if not (self.connected and modbusMsg): return ''  # check whether the input is empty.
-        if self.debug: print('M221 send: %s' % modbusMsg)
-        bdata = bytes.fromhex(modbusMsg)
-        self.plcAgent.send(bdata)
-        respBytes = self.plcAgent.recv(BUFF_SZ)
-        respStr = respBytes.dencode('hex') if DECODE_MD else respBytes.hex()
-        return respStr
+        def decoder(data):
+            if len(data) < 1 or data[0] != (count + 7)//8:
+                raise ModbusError("M221: coil byte count mismatch %s" % data.hex())
+            if start % 8 == 0: self.shadow.setBytes(start//8, data[1:])
+            return data[1:]
+        return self._request(RD_REQ.pack(M_RD, start, count), decoder, wait)
+
+#-----------------------------------------------------------------------------
+    def readRegs(self, start, count, wait=True):
+        """ Read <count> 16-bit holding registers from address <start>, return 
+            a list of int.
+        """
+        def decoder(data):
+            if len(data) < 1 or data[0] != count*2:
+                raise ModbusError("M221: register byte count mismatch %s" % data.hex())
+            return list(struct.unpack('>%dH' % count, data[1:1+count*2]))
+        return self._request(RD_REQ.pack(R_RD, start, count), decoder, wait)
+
+#-----------------------------------------------------------------------------
+    def writeMem(self, mTag, val, wait=True, force=False):
+        """ Set the plc memory address. mTag: (str)memory tag, val:(int) 0/1
+            Return True if the PLC acknowledged the write. The write is skipped
+            if the shadow image shows the bit already holds val (unless force).
+        """
+        return self.writeCoils({mTag: val}, wait=wait, force=force)
+
+#-----------------------------------------------------------------------------
+    def writeCoils(self, valDict, wait=True, force=False):
+        """ Set several plc memory addresses. valDict: {(str)memory tag: (int) 0/1}. 
+            Tags with contiguous addresses are sent in one Force Multiple Coils 
+            request and all the requests are pipelined. Return True if the PLC 
+            acknowledged all the writes (a list of Futures if wait is False).
+            The tags whose shadow bit already holds the value are skipped unless
+            force is set.
+        """
+        if not (self.connected and valDict): return None
+        if not force:
+            valDict = {tag: val for tag, val in valDict.items() 
+                       if self.shadow.changed(MEM_ADDR[tag], val)}
+        futures = []
+        for start, bits in self._coilRanges(valDict):
+            byteVals = bytearray((len(bits) + 7)//8)
+            for i, bit in enumerate(bits):
+                if bit: byteVals[i//8] |= 1 << (i % 8)
+            pdu = WR_REQ.pack(M_FC, start, len(bits), len(byteVals)) + bytes(byteVals)
+            futures.append(self._request(pdu, self._writeAck(start, bits), False))
+        if not wait: return futures
+        return all([self._result(ft) for ft in futures if ft is not None])
+
+#-----------------------------------------------------------------------------
+    def _writeAck(self, start, bits):
+        """ Return the decoder checking the write response echo, the written 
+            bits are confirmed in the shadow image when acknowledged.
+        """
+        ack = WR_RSP.pack(start, len(bits))
+        def decoder(data):
+            if data != ack: return False
+            self.shadow.setBits(start, bits)
+            return True
+        return decoder
+
+#-----------------------------------------------------------------------------
+    def shadowBytes(self, start=0, count=COIL_BYTES):
+        """ Return the %M coil bytes from the shadow image (same layout as the 
+            readCoilBytes() result) or None if not all confirmed.
+        """
+        return self.shadow.getBytes(start, count)
+
+#-----------------------------------------------------------------------------
+    def _coilRanges(self, valDict):
+        """ Split the {tag: val} dict to a list of (start address, [bit list]) 
+            contiguous address ranges.
+        """
+        ranges = []
+        for addr, val in sorted((MEM_ADDR[tag], int(val) & 1) for tag, val in valDict.items()):
+            if ranges and ranges[-1][0] + len(ranges[-1][1]) == addr:
+                ranges[-1][1].append(val)
+            else:
+                ranges.append((addr, [val]))
+        return ranges
+
+#-----------------------------------------------------------------------------
+    def _request(self, pdu, decoder, wait):
+        """ Submit the request and return the decoded result or the Future."""
+        future = self.submit(pdu, decoder=decoder)
+        if future is None or not wait: return future
+        return self._result(future)
+
+#-----------------------------------------------------------------------------
+    def _result(self, future):
+        """ Wait for the request result, the receive thread fails the request
+            after its deadline, so the wait is bounded.
+        """
+        try:
+            return future.result(timeout=self.ioTimeout*2)
+        except FutureTimeout:
+            err = plcComm.PlcTimeoutError("M221: request timeout [%s]." % self.ip)
+            self._connLost(err)
+            raise err
+
+#-----------------------------------------------------------------------------
+    def submit(self, pdu, decoder=None, callback=None):
+        """ Wrap the request PDU with a MBAP header and send it to the PLC without 
+            waiting for the response. Block only if <window> requests are already
+            in flight. Return a Future which will be set to decoder(response data
+            bytes without the function code), callback(future) is called when the 
+            response arrives.
+        """
+        if not (self.connected and pdu): return None  # check whether the input is empty.
+        future = Future()
+        if callback: future.add_done_callback(callback)
+        if not self.window.acquire(timeout=self.ioTimeout):
+            future.set_exception(plcComm.PlcTimeoutError("M221: in flight window full [%s]." % self.ip))
+            return future
+        with self.pendLock:
+            if self.lostErr is not None:
+                # The receive thread has exited: nothing would complete the request.
+                self.window.release()
+                future.set_exception(self.lostErr)
+                return future
+            self.tid = (self.tid + 1) & 0xFFFF
+            while self.tid in self.pending: self.tid = (self.tid + 1) & 0xFFFF
+            tid = self.tid
+            self.pending[tid] = (future, pdu[0], decoder, time.monotonic())
+        adu = MBAP_HDR.pack(tid, PROTOCOL_ID, len(pdu)+1, UID) + pdu
+        if self.debug: print('M221 send: %s' % adu.hex())
+        try:
+            with self.sendLock:
+                self.plcAgent.sendall(adu)
+        except OSError as err:
+            err = plcComm.classifyError(err)
+            self._finish(tid, err=err)
+            self._connLost(err)
+        return future
+
+#-----------------------------------------------------------------------------
+    def _finish(self, tid, body=None, err=None):
+        """ Pop the in flight request <tid> and set its Future."""
+        with self.pendLock:
+            item = self.pending.pop(tid, None)
+        if item is None: return False
+        self.window.release()
+        future, fc, decoder, _ = item
+        try:
+            if err is not None: raise err
+            if body[0] == fc | 0x80:
+                raise ModbusError("M221: exception code %s for function %s" % (body[1:2].hex(), fc))
+            if body[0] != fc:
+                raise ModbusError("M221: function code mismatch %s" % body.hex())
+            future.set_result(decoder(body[1:]) if decoder else body[1:])
+        except Exception as exc:
+            future.set_exception(exc)
+        return True
+
+#-----------------------------------------------------------------------------
+    def _recvExact(self, size):
+        """ Read exactly <size> bytes from the socket, a Modbus frame may be 
+            split over several TCP segments.
+        """
+        buf = bytearray()
+        while len(buf) < size:
+            try:
+                chunk = self.plcAgent.recv(min(BUFF_SZ, size - len(buf)))
+            except socket.timeout:
+                self._checkDeadline()
+                continue
+            if not chunk: raise plcComm.PlcResetError("M221: connection closed by PLC.")
+            buf += chunk
+        return bytes(buf)
+
+#-----------------------------------------------------------------------------
+    def _checkDeadline(self):
+        """ Raise PlcTimeoutError if the oldest in flight request passed its 
+            deadline (the PLC stopped answering).
+        """
+        with self.pendLock:
+            sendTimes = [item[3] for item in self.pending.values()]
+        if sendTimes and time.monotonic() - min(sendTimes) > self.ioTimeout:
+            raise plcComm.PlcTimeoutError("M221: no response in %s sec." % self.ioTimeout)
+
+#-----------------------------------------------------------------------------
+    def _recvLoop(self):
+        """ Receive thread: read the response frames and match them back to the 
+            in flight requests by transaction ID.
+        """
+        err = plcComm.PlcResetError("M221: connection closed [%s]." % self.ip)
+        try:
+            while self.connected:
+                tid, pid, length, _ = MBAP_HDR.unpack(self._recvExact(MBAP_HDR.size))
+                if pid != PROTOCOL_ID or length < 2:
+                    raise ModbusError("M221: invalid MBAP header [tid:%s len:%s]" % (tid, length))
+                body = self._recvExact(length - 1)
+                if self.debug: print('M221 recv[%s]: %s' % (tid, body.hex()))
+                if not self._finish(tid, body=body) and self.debug:
+                    print('M221 drop stale response tid: %s' % tid)
+        except (OSError, plcComm.PlcIOError) as exc:
+            err = plcComm.classifyError(exc)
+            if self.connected: 
+                print("M221: receive %s from PLC [%s]: %s" % (type(err).__name__, self.ip, err))
+        self._connLost(err, recvExit=True)
+
+#-----------------------------------------------------------------------------
+    def _connLost(self, err, recvExit=False):
+        """ Mark the connection lost after a timeout/reset error or when the 
+            receive thread exits (on any error): the socket is shut down, the
+            in flight requests and all the requests submitted later fail with
+            the error.
+        """
+        if not (recvExit or plcComm.isConnError(err)): return
+        self.connected = False
+        self.shadow.clear()
+        with self.pendLock:
+            if self.lostErr is None: self.lostErr = err
+            tids = list(self.pending.keys())
+        try:
+            self.plcAgent.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for tid in tids:
+            self._finish(tid, err=err)
 
 #-----------------------------------------------------------------------------
     def disconnect(self):
         """ Disconnect from PLC."""
         print("M221:    Disconnect from PLC.")
         self.connected = False
-        if self.plcAgent: self.plcAgent.close()
+        if self.plcAgent:
+            try:
+                self.plcAgent.shutdown(socket.SHUT_RDWR) # unblock the receive thread.
+            except OSError:
+                pass
+            self.plcAgent.close()
 
 #-----------------------------------------------------------------------------
 def testCase(mode):
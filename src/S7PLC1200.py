@@ -12,11 +12,37 @@
 # Copyright:   NUS Singtel Cyber Security Research & Development Laboratory
 # License:     YC @ NUS
 #-----------------------------------------------------------------------------
+import re
 import time
-import platform    # For getting the operating system name
-import subprocess  # For executing a shell command
+import ctypes
+from functools import lru_cache
+from collections import namedtuple
 import snap7
 from snap7.util import *
+try:
+    from snap7.snap7types import S7DataItem     # python-snap7 0.x
+except ImportError:
+    try:
+        from snap7.types import S7DataItem      # python-snap7 1.x
+    except ImportError:
+        from snap7.type import S7DataItem       # python-snap7 2.x
+
+try:
+    from snap7.snap7exceptions import Snap7Exception   # python-snap7 0.x
+except ImportError:
+    try:
+        from snap7.exceptions import Snap7Exception     # python-snap7 1.x
+    except ImportError:
+        Snap7Exception = Exception  # the error types differ in the later versions.
+
+import plcComm
+
+PLC_PORT = 102  # S7comm (ISO-TSAP) TCP port.
+SHADOW_SZ = 16  # bytes of each memory area kept in the shadow image.
+S7_WL_BYTE = 0x02   # snap7 word length code of byte data items.
+S7_PING_TIMEOUT = 3 # snap7 client parameter number of the connection timeout (ms).
+S7_SEND_TIMEOUT = 4 # snap7 client parameter number of the send timeout (ms).
+S7_RECV_TIMEOUT = 5 # snap7 client parameter number of the receive timeout (ms).
 
 # Set the output type
 OUT_BOOL = 1
@@ -24,111 +50,299 @@ OUT_INT = 2
 OUT_REAL = 3
 OUT_WORD = 4
 OUT_DWORD = 5
+OUT_BYTE = 6
+
+MEM_AREA = {'m': 0x83, 'q': 0x82, 'i': 0x81} # memory access dict.
+# Address string format: <area m/q/i><type x/b/w/d/freal><byte index>[.<bit index>]
+ADDR_PATTERN = re.compile(r'^([mqi])(?:x(\d+)\.([0-7])|(b|w|d|freal)(\d+))$')
+TYPE_CODEC = {'b': (1, OUT_BYTE), 'w': (2, OUT_WORD), 'd': (4, OUT_DWORD), 'freal': (4, OUT_REAL)}
+
+# Pre-resolved (immutable) address handle.
+s7Addr = namedtuple('s7Addr', ('tag', 'area', 'start', 'size', 'bit', 'out'))
+
+#-----------------------------------------------------------------------------
+@lru_cache(maxsize=256)
+def compileAddr(mem):
+    """ Compile the address string (such as 'qx0.2', 'mb1', 'mfreal4') to the 
+        s7Addr handle: (tag, area code, start byte, byte size, bit idx, output 
+        type). Raise ValueError if the address is malformed.
+    """
+    match = ADDR_PATTERN.match(str(mem).strip().lower())
+    if match is None: raise ValueError("S7PLC1200: malformed address: %s" % str(mem))
+    areaKey, xStart, bit, memType, start = match.groups()
+    if xStart is not None:
+        return s7Addr(match.group(0), MEM_AREA[areaKey], int(xStart), 1, int(bit), OUT_BOOL)
+    size, out = TYPE_CODEC[memType]
+    return s7Addr(match.group(0), MEM_AREA[areaKey], int(start), size, 0, out)
+
+#-----------------------------------------------------------------------------
+def toAddr(mem):
+    """ Return the s7Addr handle of an address string or handle."""
+    return mem if isinstance(mem, s7Addr) else compileAddr(mem)
+
+#-----------------------------------------------------------------------------
+def decodeAddr(addr, mbyte):
+    """ Decode the address value from its data bytes."""
+    # Call the utility functions from <snap7.util>
+    if(addr.out == OUT_BOOL):
+        return get_bool(mbyte, 0, addr.bit)
+    elif(addr.out == OUT_BYTE):
+        return mbyte[0]
+    elif(addr.out == OUT_REAL):
+        return get_real(mbyte, 0)
+    elif(addr.out == OUT_DWORD):
+        return get_dword(mbyte, 0)
+    elif(addr.out == OUT_WORD):
+        return get_int(mbyte, 0)
+
+#-----------------------------------------------------------------------------
+def encodeAddr(addr, value):
+    """ Encode the byte/word/dword/real value to the address data bytes."""
+    data = bytearray(addr.size)
+    # Call the utility functions from <snap7.util>
+    if(addr.out == OUT_BYTE):
+        data[0] = int(value) & 0xFF
+    elif(addr.out == OUT_WORD):
+        set_int(data, 0, value)
+    elif(addr.out == OUT_DWORD):
+        set_dword(data, 0, value)
+    elif(addr.out == OUT_REAL):
+        set_real(data, 0, value)
+    return data
 
 #-----------------------------------------------------------------------------
 #-----------------------------------------------------------------------------
 class S7PLC1200(object):
-    def __init__(self, ip, debug=False):
+    def __init__(self, ip, debug=False, port=PLC_PORT, connTimeout=plcComm.CONN_TIMEOUT,
+                 ioTimeout=plcComm.IO_TIMEOUT):
         self.ip = ip
+        self.port = port
+        self.connTimeout = connTimeout  # connection establish deadline (sec).
+        self.ioTimeout = ioTimeout      # request send/receive deadline (sec).
         self.debug = debug
         self.connected = False
-        self.memAreaDict = {'m': 0x83, 'q': 0x82, 'i': 0x81} # memory access dict.
+        self.memAreaDict = MEM_AREA
+        # Shadow image of the last confirmed memory state of each area.
+        self.shadow = {area: plcComm.shadowImage(SHADOW_SZ) for area in self.memAreaDict.values()}
+        self.snapTags = set()   # address handles read by refreshSnapshot().
+        self.snapRanges = []    # merged [area, start, size] byte ranges of the snapTags.
+        self.snapshot = {}      # {(area, start): bytearray} data of the last refresh.
+        self.snapTime = None    # time.monotonic() of the last snapshot refresh.
         self.plc = None
-        if self._pingPLC(self.ip):
+        if self._probePLC(self.ip):
             self.plc = snap7.client.Client()
             try:
-                self.plc.connect(ip, 0, 1)  # connect to the PLC
+                self.plc.set_param(S7_PING_TIMEOUT, int(self.connTimeout*1000))
+                self.plc.set_param(S7_SEND_TIMEOUT, int(self.ioTimeout*1000))
+                self.plc.set_param(S7_RECV_TIMEOUT, int(self.ioTimeout*1000))
+                self.plc.connect(ip, 0, 1, self.port)  # connect to the PLC
+                self._setIoTimeout()
                 self.connected = True
-            except snap7.snap7exceptions.Snap7Exception as error:
+            except Snap7Exception as error:
                 print('S7PLC1200 ERROR: %s' %error)
 
 #-----------------------------------------------------------------------------
-    def _pingPLC(self, host):
-        """ Returns True if host (str) responds to a ping request. Remember that a host 
-            may not respond to a ping (ICMP) request even if the host name is valid.
+    def _setIoTimeout(self):
+        """ The python-snap7 3.x pure python client only records the timeout 
+            parameters, its connection uses a fixed 5 sec socket timeout: set 
+            the request deadline on the connection and its socket directly. 
+            (The connect handshake keeps the library's timeout on 3.x, the 
+            TCP connect is bounded by the _probePLC() check before.)
         """
-        # Option for the number of packets as a function of
-        param = '-n' if platform.system().lower()=='windows' else '-c'
-        # Building the command. Ex: "ping -c 1 google.com"
-        command = ['ping', param, '1', host]
-        return subprocess.call(command) == 0
+        conn = getattr(self.plc, 'connection', None)
+        if conn is None: return     # native snap7 library: set_param() applies.
+        conn.timeout = self.ioTimeout
+        if getattr(conn, 'socket', None): conn.socket.settimeout(self.ioTimeout)
+
+#-----------------------------------------------------------------------------
+    def _probePLC(self, host):
+        """ Returns True if the PLC's S7comm port accepts a TCP connection in the
+            short probe deadline.
+        """
+        return plcComm.tcpProbe(host, self.port)
+
+#-----------------------------------------------------------------------------
+    def _io(self, func, *args):
+        """ Call the snap7 client function, the errors are raised as the 
+            plcComm.PlcIOError subclasses. After a timeout/reset the client is
+            marked disconnected (and the shadow image cleared) so the next
+            calls fail fast until it is reconnected.
+        """
+        try:
+            return func(*args)
+        except Exception as err:
+            ioErr = plcComm.classifyError(err)
+            if plcComm.isConnError(ioErr):
+                if self.connected: print("S7PLC1200: %s [%s]: %s" % (type(ioErr).__name__, self.ip, err))
+                self.connected = False
+                for image in self.shadow.values(): image.clear()
+            raise ioErr from err
 
 #-----------------------------------------------------------------------------
     def getMem(self, mem, returnByte=False):
         """ Get the PLC state from related memeory address: IX0.N-input, QX0.N-output, 
-            MX0.N-memory
+            MX0.N-memory. mem is the address string or its compileAddr() handle.
         """
         if not self.connected: return None
-        out = None  # output functino selection type
-        start = 0  # start position idx
-        bit = 0
-        length = 1  # data length
-        # get the area memory address
-        memType = mem[0].lower()
-        area = self.memAreaDict[memType]
-        # Set the data lenght and start idx.
-        if(mem[1].lower() == 'x'):  # bit
-            length, out, start, bit = 1, OUT_BOOL, int(
-                mem.split('.')[0][2:]), int(mem.split('.')[1])
-        elif(mem[1].lower() == 'b'):  # byte
-            length, out, start = 1, OUT_INT, int(mem[2:])
-        elif(mem[1].lower() == 'w'):  # word
-            length, out, start = 2, OUT_INT, int(mem[2:])
-        elif(mem[1].lower() == 'd'):  # double
-            length, out, start = 4, OUT_DWORD, int(mem.split('.')[0][2:])
-        elif('freal' in mem.lower()):  # double word (real numbers)
-            length, out, start = 4, OUT_REAL, int(mem.lower().replace('freal', ''))
+        addr = toAddr(mem)
         # Read data from the PLC
-        mbyte = self.plc.read_area(area, 0, start, length)
+        mbyte = self._io(self.plc.read_area, addr.area, 0, addr.start, addr.size)
+        self.shadow[addr.area].setBytes(addr.start, mbyte)
         if(self.debug):
-            print("S7PLC1200 getMem() get data set[mem[0], start, length, bit, mbyte]:" % str(
-                mem[0].lower(), start, length, bit, str(mbyte)))
-        # Call the utility functions from <snap7.util>
-        if(returnByte):
-            return mbyte
-        elif(out == OUT_BOOL):
-            return get_bool(mbyte, 0, bit)
-        elif(out == OUT_INT):
-            return get_int(mbyte, start)
-        elif(out == OUT_REAL):
-            return get_real(mbyte, 0)
-        elif(out == OUT_DWORD):
-            return get_dword(mbyte, 0)
-        elif(out == OUT_WORD):
-            return get_int(mbyte, start)
-
-#-----------------------------------------------------------------------------
-    def writeMem(self, mem, value):
+            print("S7PLC1200 getMem() get data set[%s]: %s" % (str(addr), str(mbyte)))
+        return mbyte if returnByte else decodeAddr(addr, mbyte)
+
+#-----------------------------------------------------------------------------
+    def writeMem(self, mem, value, force=False):
         """ Set the PLC state from related memeory address: IX0.N-input, QX0.N-output, 
-            MX0.N-memory.
+            MX0.N-memory. A bit write is skipped if the shadow image shows the 
+            bit already holds the value (unless force is set).
         """
         if not self.connected: return None
-        data = self.getMem(mem, True)
-        start = bit = 0  # start position idx
-        # get the area memory address
-        memType = mem[0].lower()
-        area = self.memAreaDict[memType]
-        # Set the data lenght and start idx and call the utility functions from <snap7.util>
-        if(mem[1].lower() == 'x'):  # bit
-            start, bit = int(mem.split('.')[0][2:]), int(mem.split('.')[1])
-            set_bool(data, 0, bit, int(value))
-        elif(mem[1].lower() == 'b'):  # byte
-            start = int(mem[2:])
-            set_int(data, 0, value)
-        elif(mem[1].lower() == 'd'):
-            start = int(mem.split('.')[0][2:])
-            set_dword(data, 0, value)
-        elif('freal' in mem.lower()):  # double word (real numbers)
-            start = int(mem.lower().replace('freal', ''))
-            set_real(data, 0, value)
+        addr = toAddr(mem)
+        if addr.out == OUT_BOOL: return self.writeBits({addr: value}, force=force)
+        data = encodeAddr(addr, value)
         # Call the write function and return the value.
-        return self.plc.write_area(area, 0, start, data)
+        result = self._io(self.plc.write_area, addr.area, 0, addr.start, data)
+        self.shadow[addr.area].setBytes(addr.start, data)
+        return result
+
+#-----------------------------------------------------------------------------
+    def writeBits(self, valDict, force=False):
+        """ Set several bit addresses in one batch, valDict example: 
+            {'qx0.3': False, 'qx0.4': True} (the keys can also be handles). Each
+            affected byte is read once, all the bit changes are applied and each
+            byte is written once. Contiguous bytes are merged to one range and 
+            several ranges are read/written by one multi-variable request. The 
+            bits whose shadow value already equals the new value are skipped 
+            unless force is set.
+        """
+        if not self.connected: return None
+        changes = {}    # {(area, byte idx): {bit idx: val}}
+        for mem, val in valDict.items():
+            addr = toAddr(mem)
+            if addr.out != OUT_BOOL: 
+                raise ValueError("S7PLC1200: writeBits() address is not a bit: %s" % addr.tag)
+            if force or self.shadow[addr.area].changed(addr.start*8 + addr.bit, val):
+                changes.setdefault((addr.area, addr.start), {})[addr.bit] = val
+        if not changes: return 0
+        ranges = self._mergeRanges(changes.keys())
+        dataList = self._readRanges(ranges)
+        for (area, start, size), data in zip(ranges, dataList):
+            for i in range(size):
+                for bit, val in changes.get((area, start+i), {}).items():
+                    set_bool(data, i, bit, int(val))
+        result = self._writeRanges(ranges, dataList)
+        for (area, start, _), data in zip(ranges, dataList):
+            self.shadow[area].setBytes(start, data)
+        return result
+
+#-----------------------------------------------------------------------------
+    def registerTags(self, tags):
+        """ Add the addresses (strings or handles) to the snapshot read by 
+            refreshSnapshot(), a malformed address raises ValueError here.
+        """
+        self.snapTags.update(toAddr(mem) for mem in tags)
+        self.snapRanges = self._mergeRanges((addr.area, addr.start + i) 
+                                            for addr in self.snapTags for i in range(addr.size))
+
+#-----------------------------------------------------------------------------
+    def refreshSnapshot(self):
+        """ Read all the registered addresses in one request (one read_area for
+            one contiguous range, else one read_multi_vars), the number of snap7
+            requests does not grow with the number of registered tags. Return 
+            True if the snapshot is updated.
+        """
+        if not (self.connected and self.snapRanges): return False
+        dataList = self._readRanges(self.snapRanges)
+        self.snapshot = {(area, start): data for (area, start, _), data in zip(self.snapRanges, dataList)}
+        self.snapTime = time.monotonic()
+        return True
+
+#-----------------------------------------------------------------------------
+    def snapshotBytes(self, mem):
+        """ Return the data bytes of the address in the last snapshot, None if the
+            address is not covered by the registered tags.
+        """
+        addr = toAddr(mem)
+        for (area, start), data in self.snapshot.items():
+            if area == addr.area and start <= addr.start and addr.start + addr.size <= start + len(data):
+                return data[addr.start - start: addr.start - start + addr.size]
+        return None
+
+#-----------------------------------------------------------------------------
+    def getSnapshot(self, mem):
+        """ Return the address value from the last snapshot (no PLC access), None 
+            if it is not in the snapshot. Check snapTime for the data age.
+        """
+        mbyte = self.snapshotBytes(mem)
+        return None if mbyte is None else decodeAddr(toAddr(mem), mbyte)
+
+#-----------------------------------------------------------------------------
+    def _mergeRanges(self, byteKeys):
+        """ Merge the (area, byte idx) keys to the [[area, start, size]] contiguous 
+            byte ranges.
+        """
+        ranges = []
+        for area, start in sorted(set(byteKeys)):
+            if ranges and ranges[-1][0] == area and sum(ranges[-1][1:]) == start:
+                ranges[-1][2] += 1
+            else:
+                ranges.append([area, start, 1])
+        return ranges
+
+#-----------------------------------------------------------------------------
+    def _dataItem(self, area, start, data):
+        """ Build a snap7 multi-variable data item on the byte buffer <data>."""
+        buffer = (ctypes.c_uint8 * len(data)).from_buffer(data)
+        item = S7DataItem()
+        item.Area = ctypes.c_int32(area)
+        item.WordLen = ctypes.c_int32(S7_WL_BYTE)
+        item.Result = ctypes.c_int32(0)
+        item.DBNumber = ctypes.c_int32(0)
+        item.Start = ctypes.c_int32(start)
+        item.Amount = ctypes.c_int32(len(data))
+        item.pData = ctypes.cast(buffer, ctypes.POINTER(ctypes.c_uint8))
+        return item
+
+#-----------------------------------------------------------------------------
+    def _readRanges(self, ranges):
+        """ Read the [(area, start, size)] byte ranges, return the bytearray list."""
+        if len(ranges) == 1:
+            area, start, size = ranges[0]
+            data = self._io(self.plc.read_area, area, 0, start, size)
+            self.shadow[area].setBytes(start, data)
+            return [data]
+        dataList = [bytearray(size) for (_, _, size) in ranges]
+        items = [self._dataItem(area, start, data) for (area, start, _), data in zip(ranges, dataList)]
+        self._io(self.plc.read_multi_vars, (S7DataItem * len(items))(*items))
+        for (area, start, _), data in zip(ranges, dataList):
+            self.shadow[area].setBytes(start, data)
+        return dataList
+
+#-----------------------------------------------------------------------------
+    def _writeRanges(self, ranges, dataList):
+        """ Write the bytearray list to the [(area, start, size)] byte ranges."""
+        if len(ranges) == 1:
+            area, start, _ = ranges[0]
+            return self._io(self.plc.write_area, area, 0, start, dataList[0])
+        items = [self._dataItem(area, start, data) for (area, start, _), data in zip(ranges, dataList)]
+        return self._io(self.plc.write_multi_vars, items)
+
+#-----------------------------------------------------------------------------
+    def shadowBytes(self, mem='qb0'):
+        """ Return the bytes of the address <mem> in the shadow image (same as 
+            getMem(mem, True)), None if unknown.
+        """
+        addr = toAddr(mem)
+        return self.shadow[addr.area].getBytes(addr.start, addr.size)
 
 #-----------------------------------------------------------------------------
     def disconnect(self):
         """ Disconnect from PLC."""
         print("S7PLC1200:    Disconnect from PLC.")
         self.connected = False
+        for image in self.shadow.values(): image.clear()
         if self.plc: self.plc.disconnect()
 
 #-----------------------------------------------------------------------------
@@ -0,0 +1,232 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        S7Sim.py
+#
+# Purpose:     This module provides a local snap7 server emulating the Siemens
+#              S7-1200 PLC (plc2) I/Q/M memory areas used by <S7PLC1200> and
+#              <pwrGenMgr>, so the S7 client, the bit write batching and the
+#              snapshot reads can be tested and benchmarked without the
+#              physical PLC. The values can be changed by a timed script and
+#              the responses can be delayed by a latency/jitter relay.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/22
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import time
+import heapq
+import ctypes
+import random
+import socket
+import threading
+
+import snap7
+try:
+    from snap7.type import SrvArea          # python-snap7 2.x
+    SRV_AREA = {0x81: SrvArea.PE, 0x82: SrvArea.PA, 0x83: SrvArea.MK}
+    def newBuffer(size): return bytearray(size)
+except ImportError:
+    SRV_AREA = {0x81: 0, 0x82: 1, 0x83: 2}  # snap7 srvAreaPE/PA/MK codes.
+    def newBuffer(size): return (ctypes.c_ubyte * size)()
+
+import S7PLC1200 as s71200
+
+SIM_PORT = 1102     # non-privileged S7comm port of the local server.
+AREA_SZ = 64        # bytes of each emulated memory area.
+BUFF_SZ = 4096
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class S7Sim(threading.Thread):
+    """ S7-1200 stand-in server thread. The snap7 server listens on <srvPort>,
+        if latency or jitter is set the clients connect to the delay relay on
+        self.port instead (use port=0 to get a free relay port from the OS).
+        init example: sim = S7Sim(None, latency=0.005); sim.start()
+                      plc = S7PLC1200(sim.ip, port=sim.port)
+    """
+    def __init__(self, parent, host='127.0.0.1', srvPort=SIM_PORT, port=0,
+                 latency=0, jitter=0, debug=False):
+        threading.Thread.__init__(self, daemon=True)
+        self.parent = parent
+        self.ip = host
+        self.srvPort = srvPort
+        self.latency = latency      # fixed delay of each response chunk (sec).
+        self.jitter = jitter        # random extra delay [0, jitter) (sec).
+        self.debug = debug
+        self.areas = {area: newBuffer(AREA_SZ) for area in SRV_AREA}
+        self.server = snap7.server.Server(debug)
+        for area, srvArea in SRV_AREA.items():
+            self.server.register_area(srvArea, 0, self.areas[area])
+        self.relay = None
+        if latency or jitter:
+            self.relay = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.relay.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.relay.bind((host, port))
+            self.relay.listen(4)
+        self.port = self.relay.getsockname()[1] if self.relay else srvPort
+        self.terminate = threading.Event()
+        self.scriptTimers = []
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Start the snap7 server and the relay accept loop (if configured)."""
+        self.server.start(tcp_port=self.srvPort)
+        while self.relay and not self.terminate.is_set():
+            try:
+                conn, _ = self.relay.accept()
+            except OSError:
+                break   # relay socket closed by stop().
+            threading.Thread(target=self._relayClient, args=(conn,), daemon=True).start()
+        self.terminate.wait()
+        self.server.stop()
+        self.server.destroy()
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Cancel the script and stop the server."""
+        for timer in self.scriptTimers: timer.cancel()
+        self.terminate.set()
+        if self.relay: self.relay.close()
+
+#-----------------------------------------------------------------------------
+    def setValue(self, mem, val):
+        """ Set the value of the address string (such as 'qx0.2', 'mb1') as the
+            PLC program would do.
+        """
+        addr = s71200.toAddr(mem)
+        buf = self.areas[addr.area]
+        if addr.out == s71200.OUT_BOOL:
+            if val:
+                buf[addr.start] |= 1 << addr.bit
+            else:
+                buf[addr.start] &= ~(1 << addr.bit) & 0xFF
+        else:
+            data = s71200.encodeAddr(addr, val)
+            for i, byte in enumerate(data): buf[addr.start+i] = byte
+
+#-----------------------------------------------------------------------------
+    def getValue(self, mem):
+        """ Return the current value of the address string."""
+        addr = s71200.toAddr(mem)
+        mbyte = bytearray(self.areas[addr.area][addr.start:addr.start+addr.size])
+        return s71200.decodeAddr(addr, mbyte)
+
+#-----------------------------------------------------------------------------
+    def runScript(self, script):
+        """ Schedule the scripted value changes [(offset sec, mem, val), ...],
+            the offsets are counted from now.
+        """
+        for offset, mem, val in script:
+            timer = threading.Timer(offset, self.setValue, (mem, val))
+            timer.daemon = True
+            self.scriptTimers.append(timer)
+            timer.start()
+
+#-----------------------------------------------------------------------------
+    def _relayClient(self, conn):
+        """ Relay one client connection to the snap7 server, the server to client
+            data is sent after latency + jitter (in order).
+        """
+        try:
+            srv = socket.create_connection(('127.0.0.1', self.srvPort))
+        except OSError:
+            conn.close()
+            return
+        queue, cond = [], threading.Condition()
+
+        def upLink():
+            try:
+                while True:
+                    data = conn.recv(BUFF_SZ)
+                    if not data: break
+                    srv.sendall(data)
+            except OSError:
+                pass
+            for sock in (srv, conn):
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+        def sender():
+            while True:
+                with cond:
+                    while not queue: cond.wait()
+                    dueT, _, data = heapq.heappop(queue)
+                if data is None: break
+                time.sleep(max(0, dueT - time.monotonic()))
+                try:
+                    conn.sendall(data)
+                except OSError:
+                    break
+            conn.close()
+            srv.close()
+
+        threading.Thread(target=upLink, daemon=True).start()
+        threading.Thread(target=sender, daemon=True).start()
+        seq, lastT = 0, 0
+        while True:
+            try:
+                data = srv.recv(BUFF_SZ)
+            except OSError:
+                data = b''
+            # keep the chunks in order: a chunk is never due before the previous.
+            lastT = max(lastT, time.monotonic() + self.latency + random.uniform(0, self.jitter))
+            seq += 1
+            with cond:
+                heapq.heappush(queue, (lastT, seq, data or None))
+                cond.notify()
+            if not data: break
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        print("Benchmark the S7PLC1200 client with a 5ms latency simulator:")
+        sim = S7Sim(None, latency=0.005)
+        sim.start()
+        time.sleep(0.2)
+        plc = s71200.S7PLC1200(sim.ip, port=sim.port)
+        tags = ['qx0.%s' % i for i in range(5)]
+        startT = time.monotonic()
+        for _ in range(20):
+            for tag in tags: plc.writeMem(tag, 1, force=True)
+        print("per bit writes: %.3f sec" % (time.monotonic() - startT))
+        startT = time.monotonic()
+        for _ in range(20):
+            plc.writeBits({tag: 1 for tag in tags}, force=True)
+        print("batched writes: %.3f sec" % (time.monotonic() - startT))
+        plc.registerTags(tags)
+        startT = time.monotonic()
+        for _ in range(20):
+            values = [plc.getMem(tag) for tag in tags]
+        print("per tag reads: %.3f sec" % (time.monotonic() - startT))
+        startT = time.monotonic()
+        for _ in range(20):
+            plc.refreshSnapshot()
+            values = [plc.getSnapshot(tag) for tag in tags]
+        print("snapshot reads: %.3f sec %s" % (time.monotonic() - startT, values))
+        plc.disconnect()
+        sim.stop()
+    elif mode == 1:
+        print("Scripted value change test:")
+        sim = S7Sim(None)
+        sim.start()
+        time.sleep(0.2)
+        plc = s71200.S7PLC1200(sim.ip, port=sim.port)
+        sim.runScript([(0.5, 'qx0.2', 1), (1, 'mfreal4', 49.8)])
+        for _ in range(3):
+            print("qx0.2: %s, mfreal4: %s" % (plc.getMem('qx0.2'), plc.getMem('mfreal4')))
+            time.sleep(0.6)
+        plc.disconnect()
+        sim.stop()
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
@@ -0,0 +1,375 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        devDriver.py
+#
+# Purpose:     This module provides the asyncio device driver layer on top of
+#              the blocking device modules (M221, S7PLC1200 and serialCom), so
+#              all the devices can be driven from one event loop:
+#                   await drv.read(tag), await drv.write(tag, val),
+#                   await drv.batch({tag: val, ...})
+#              The M221 requests are pipelined on the PLC socket, the snap7
+#              and serial port calls run on the loop's thread pool executor.
+#              Each device can be owned by a devActor worker thread which
+#              serializes all the calls to the device in priority order
+#              (operator > scenario > auto control > poll) with bounded queues
+#              and per request deadlines, the drivers then submit through it.
+#              An actor with a circuit breaker fast-fails the requests while
+#              its device keeps failing.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/18
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import time
+import queue
+import asyncio
+import itertools
+import threading
+from functools import partial
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeout
+
+import plcComm
+import M2PLC221 as m221
+
+# Arduino serial command field sequence: Freq:Volt:Fled:Vled:Mled:Pled:Smok:Sirn
+SERIAL_SQU = ('Freq', 'Volt', 'Fled', 'Vled', 'Mled', 'Pled', 'Smok', 'Sirn')
+
+# Device request priority classes (lower value is served first).
+PRI_OPER = 0    # emergency stop/recovery and the operator's UI commands.
+PRI_SCN = 1     # attack scenario actions.
+PRI_AUTO = 2    # generator auto control.
+PRI_POLL = 3    # background load state polling.
+PRI_STOP = -1   # actor stop request.
+ACTOR_QSZ = 8   # max queued requests of each priority class.
+ACTOR_TIMEOUT = 2   # default request deadline (sec).
+IO_WAIT = plcComm.IO_TIMEOUT + 1    # max wait of a pipelined M221 response (sec).
+
+#-----------------------------------------------------------------------------
+class ActorBusyError(Exception):
+    """ The request's priority class queue of the device actor is full."""
+
+#-----------------------------------------------------------------------------
+class ActorTimeoutError(Exception):
+    """ The request's deadline passed before the device actor served it."""
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class devActor(threading.Thread):
+    """ Worker thread owning one device: all the device calls are queued and
+        executed one by one in priority order, so the requests from the main
+        loop, the UDP handler and the scenario runner never interleave on the
+        device link. <device> is the device object or a function returning the
+        current device object, the request gets None if it is not connected.
+        If a plcComm circuitBreaker is given, the requests fail with 
+        CircuitOpenError while it is open: when a request completes (for the 
+        pipelined M221 requests, when their response futures are done) it 
+        counts as failed if the device is (or became) disconnected or it 
+        raised a timeout/reset error. The half-open probe request is preceded
+        by the <probe>(device) read (truthy on success) so a request skipped as
+        a no-op by the shadow image can't close the breaker without any device
+        I/O, the request fails with CircuitOpenError if the probe fails.
+        init example: actor = devActor('plc1', lambda: self.plc1); actor.start()
+                      data = actor.call('readCoilBytes', 0, 8, priority=PRI_POLL)
+    """
+    def __init__(self, name, device, queueSize=ACTOR_QSZ, breaker=None, probe=None):
+        threading.Thread.__init__(self, name='%s actor' % name, daemon=True)
+        self.getDevice = device if callable(device) else (lambda: device)
+        self.breaker = breaker
+        self.probe = probe
+        self.queueSize = queueSize
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()    # FIFO order inside a priority class.
+        self.pendCount = {}             # {priority: queued request count}
+        self.lock = threading.Lock()
+        self.busy = False               # a request is being executed.
+
+#-----------------------------------------------------------------------------
+    def submit(self, func, *args, priority=PRI_POLL, timeout=ACTOR_TIMEOUT):
+        """ Queue the call func(device, *args), <func> is a device method name
+            or a function. Return a concurrent.futures.Future which fails with 
+            ActorBusyError if the priority class queue is full or with 
+            ActorTimeoutError if the request is not served in <timeout> sec.
+        """
+        future = Future()
+        if self.breaker and not self.breaker.ready():
+            # Fast-fail: don't queue the request behind the sick device.
+            future.set_exception(plcComm.CircuitOpenError("%s: circuit breaker open." % self.name))
+            return future
+        with self.lock:
+            if self.pendCount.get(priority, 0) >= self.queueSize:
+                future.set_exception(ActorBusyError("%s: priority %s queue full." % (self.name, priority)))
+                return future
+            self.pendCount[priority] = self.pendCount.get(priority, 0) + 1
+        self.queue.put((priority, next(self.seq), time.monotonic() + timeout, future, func, args))
+        return future
+
+#-----------------------------------------------------------------------------
+    def call(self, func, *args, priority=PRI_OPER, timeout=ACTOR_TIMEOUT):
+        """ Submit the call and wait for its result (blocking), raise 
+            ActorTimeoutError if it is not done in <timeout> sec.
+        """
+        future = self.submit(func, *args, priority=priority, timeout=timeout)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()     # skipped by the worker if still queued.
+            raise ActorTimeoutError("%s: request not done in %s sec." % (self.name, timeout))
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Serve the queued requests until stop() is called."""
+        while True:
+            priority, _, deadline, future, func, args = self.queue.get()
+            if priority == PRI_STOP: break
+            with self.lock:
+                self.pendCount[priority] -= 1
+            if not future.set_running_or_notify_cancel(): continue
+            if time.monotonic() > deadline:
+                future.set_exception(ActorTimeoutError("%s: request deadline passed." % self.name))
+                continue
+            if self.breaker and not self.breaker.allow():
+                future.set_exception(plcComm.CircuitOpenError("%s: circuit breaker open." % self.name))
+                continue
+            # The breaker is half-open only while this request holds the probe.
+            probing = bool(self.breaker and self.probe) and self.breaker.state == plcComm.BR_HALF
+            self.busy = True
+            result, error = None, None
+            try:
+                device = self.getDevice()
+                if probing and not self._runProbe(device):
+                    raise plcComm.CircuitOpenError("%s: half-open probe failed." % self.name)
+                if device is not None and device.connected:
+                    method = getattr(device, func) if isinstance(func, str) else partial(func, device)
+                    result = method(*args)
+            except Exception as err:
+                error = err
+            self.busy = False
+            if self.breaker and not probing:
+                # The pipelined M221 requests return their response futures.
+                respFts = [ft for ft in (result if isinstance(result, list) else [result]) 
+                           if isinstance(ft, Future)]
+                self._track(respFts or [future])
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        # Fail the requests left in the queue.
+        while not self.queue.empty():
+            future = self.queue.get_nowait()[3]
+            if future and future.set_running_or_notify_cancel():
+                future.set_exception(ActorTimeoutError("%s: actor stopped." % self.name))
+
+#-----------------------------------------------------------------------------
+    def _runProbe(self, device):
+        """ Run the half-open probe read on the device and report its result to
+            the breaker, return True if the device answered.
+        """
+        try:
+            answered = device is not None and device.connected and bool(self.probe(device))
+        except Exception:
+            answered = False
+        if answered and device.connected:
+            self.breaker.success()
+            return True
+        self.breaker.failure()
+        return False
+
+#-----------------------------------------------------------------------------
+    def _track(self, futures):
+        """ Report the request result to the circuit breaker once all its 
+            futures are done.
+        """
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]: return
+            errors = [plcComm.classifyError(ft.exception()) for ft in futures
+                      if not ft.cancelled() and ft.exception() is not None]
+            device = self.getDevice()
+            if any(plcComm.isConnError(err) for err in errors) or device is None or not device.connected:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+
+        for ft in futures: ft.add_done_callback(done)
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the worker after the current request."""
+        self.queue.put((PRI_STOP, next(self.seq), 0, None, None, ()))
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class asyncDriver(object):
+    """ Asyncio device driver interface. <device> is the device object or a
+        function returning the current device object (the PLC objects are
+        re-created when reconnected). If the device <actor> is given all the
+        calls are submitted to it with the request <priority> (default poll
+        priority for the reads and operator priority for the writes). All the
+        coroutines return None if the device is not connected.
+    """
+    def __init__(self, device, executor=None, actor=None):
+        self.getDevice = device if callable(device) else (lambda: device)
+        self.executor = executor    # None: use the event loop's default executor.
+        self.actor = actor
+
+#-----------------------------------------------------------------------------
+    def _connDevice(self):
+        """ Return the current device object or None if it is not connected."""
+        device = self.getDevice()
+        return device if (device is not None and device.connected) else None
+
+#-----------------------------------------------------------------------------
+    async def _run(self, func, *args):
+        """ Run the blocking function on the executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args))
+
+#-----------------------------------------------------------------------------
+    async def _call(self, method, *args, priority=PRI_OPER):
+        """ Call the device method (name) through the actor or on the executor,
+            return None if the device is not connected.
+        """
+        if self.actor:
+            return await asyncio.wrap_future(self.actor.submit(method, *args, priority=priority))
+        device = self._connDevice()
+        if device is None: return None
+        return await self._run(getattr(device, method), *args)
+
+#-----------------------------------------------------------------------------
+    async def read(self, tag=None, priority=PRI_POLL):
+        """ Read the value of the tag (or the whole device state if tag is None)."""
+        raise NotImplementedError
+
+#-----------------------------------------------------------------------------
+    async def write(self, tag, val, force=False, priority=PRI_OPER):
+        """ Write the value to the tag. The PLC drivers skip the write if the 
+            device's shadow image shows the tag already holds the value, set 
+            force to always send it.
+        """
+        raise NotImplementedError
+
+#-----------------------------------------------------------------------------
+    async def batch(self, valDict, force=False, priority=PRI_OPER):
+        """ Write a {tag: val} dict to the device."""
+        raise NotImplementedError
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class m221Driver(asyncDriver):
+    """ Schneider M221 driver, tags are the MEM_ADDR keys. The requests are
+        submitted to the pipelined M221 client and awaited on their Futures.
+    """
+    async def _await(self, method, *args, priority=PRI_OPER):
+        """ Submit the request (submit may wait for the in-flight window) and
+            await the M221 Future, raise PlcTimeoutError if it is not done in
+            IO_WAIT sec.
+        """
+        result = await self._call(method, *args, priority=priority)
+        if result is None: return None
+        if isinstance(result, list):
+            waiter = asyncio.gather(*[asyncio.wrap_future(ft) for ft in result if ft])
+        else:
+            waiter = asyncio.wrap_future(result)
+        try:
+            return await asyncio.wait_for(waiter, IO_WAIT)
+        except asyncio.TimeoutError:
+            raise plcComm.PlcTimeoutError("M221 response wait timeout.")
+
+    async def read(self, tag=None, priority=PRI_POLL):
+        bits = await self._await('readMem', False, priority=priority)
+        if bits is None: return None
+        return bits if tag is None else bits[m221.MEM_ADDR[tag]]
+
+    async def write(self, tag, val, force=False, priority=PRI_OPER):
+        return await self.batch({tag: val}, force=force, priority=priority)
+
+    async def batch(self, valDict, force=False, priority=PRI_OPER):
+        acks = await self._await('writeCoils', valDict, False, force, priority=priority)
+        return None if acks is None else all(acks)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class s7Driver(asyncDriver):
+    """ Siemens S7-1200 driver, tags are the S7PLC1200 memory strings such as
+        'qx0.2' (batch only takes bit addresses). The snap7 calls run on the 
+        device actor or the executor.
+    """
+    async def read(self, tag=None, priority=PRI_POLL):
+        return await self._call('getMem', tag, priority=priority)
+
+    async def write(self, tag, val, force=False, priority=PRI_OPER):
+        return await self._call('writeMem', tag, val, force, priority=priority)
+
+    async def batch(self, valDict, force=False, priority=PRI_OPER):
+        return await self._call('writeBits', valDict, force, priority=priority)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class serialDriver(asyncDriver):
+    """ Arduino serial link driver, tags are the generator state fields in
+        SERIAL_SQU. A batch is sent as one 'Freq:Volt:...' command string with
+        '-' for the unchanged fields. The serial port I/O runs on the device
+        actor or the executor.
+    """
+    async def read(self, tag=None, priority=PRI_POLL):
+        return await self._call('readline', priority=priority)
+
+    async def write(self, tag, val, force=False, priority=PRI_OPER):
+        return await self.batch({tag: val}, priority=priority)
+
+    async def batch(self, valDict, force=False, priority=PRI_OPER):
+        msgStr = ':'.join([str(valDict.get(key, '-')) for key in SERIAL_SQU])
+        return await self._call('write', msgStr.encode('utf-8'), priority=priority)
+
+#-----------------------------------------------------------------------------
+async def gatherAll(*coros):
+    """ Run the driver coroutines concurrently, return their results (or the
+        exceptions raised) in order.
+    """
+    return await asyncio.gather(*coros, return_exceptions=True)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class loopThread(threading.Thread):
+    """ Thread running an asyncio event loop for the device drivers, the other
+        threads call runCoro(coroutine) to execute driver coroutines on it.
+    """
+    def __init__(self, name='devDriver loop'):
+        threading.Thread.__init__(self, name=name, daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def runCoro(self, coro):
+        """ Schedule the coroutine on the loop, return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        plc = m221.M221('192.168.10.71', debug=True)
+        drv = m221Driver(plc)
+        print(asyncio.run(drv.read('M10')))
+        print(asyncio.run(drv.batch({'M4': 1, 'M5': 1})))
+        plc.disconnect()
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
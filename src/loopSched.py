@@ -0,0 +1,298 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        loopSched.py
+#
+# Purpose:     This module provides a deadline based periodic task scheduler
+#              for the control main loop: the ticks are scheduled on the
+#              monotonic clock at a fixed rate (the I/O time of a cycle does not
+#              shift the next tick), each task runs at its own period, and the
+#              tick jitter, the task durations and the overruns (cycles which
+#              missed their budget) are recorded. The pausable tasks can be
+#              paused/resumed by the other threads (e.g. during the attack
+#              simulation), the loop blocks on an event while all are paused.
+#              The adaptivePeriod helper adapts a task period to the changes.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/24
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import time
+import math
+import threading
+
+TICK_INT = 1    # default base tick period (sec).
+PERIOD_TOL = 1e-6   # tolerance used when comparing the deadlines.
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class timeStats(object):
+    """ Running statistics (count/min/max/mean/std) of a time value in sec."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = self.sqTotal = 0.0
+        self.minVal = self.maxVal = None
+        self.lastVal = None
+
+    def add(self, val):
+        self.count += 1
+        self.total += val
+        self.sqTotal += val*val
+        self.minVal = val if self.minVal is None else min(self.minVal, val)
+        self.maxVal = val if self.maxVal is None else max(self.maxVal, val)
+        self.lastVal = val
+
+    def toDict(self):
+        """ Return the statistics in milliseconds."""
+        if not self.count: return {'count': 0}
+        mean = self.total/self.count
+        std = math.sqrt(max(0.0, self.sqTotal/self.count - mean*mean))
+        return {'count': self.count,
+                'min': round(self.minVal*1000, 3),
+                'max': round(self.maxVal*1000, 3),
+                'mean': round(mean*1000, 3),
+                'std': round(std*1000, 3)}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class periodicTask(object):
+    """ A task function called every <period> sec. The task overruns if one call
+        takes longer than its budget (default the period). A pausable task is
+        not called while the scheduler is paused.
+    """
+    def __init__(self, name, func, period, budget=None, pausable=False):
+        self.name = name
+        self.func = func
+        self.period = period
+        self.budget = budget or period
+        self.pausable = pausable
+        self.nextT = None           # monotonic deadline of the next call.
+        self.lastT = None           # deadline of the last call.
+        self.duration = timeStats() # call duration.
+        self.overrunCount = 0       # calls which took longer than the budget.
+        self.missedCount = 0        # calls skipped as their deadline passed.
+        self.errCount = 0           # calls which raised an exception.
+
+    def toDict(self):
+        return {'period': self.period,
+                'duration': self.duration.toDict(),
+                'overrun': self.overrunCount,
+                'missed': self.missedCount,
+                'error': self.errCount}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class adaptivePeriod(object):
+    """ Task period adapted to the observed changes: the period drops to minT 
+        when a change is seen (or boost() is called) and is multiplied by the
+        backoff after <hold> calls without change, up to maxT.
+        init example: rate = adaptivePeriod(0.25, 4); period = rate.update(changed)
+    """
+    def __init__(self, minT, maxT, backoff=2, hold=4, initT=None):
+        self.minT = minT
+        self.maxT = maxT
+        self.backoff = backoff
+        self.hold = hold
+        self.period = initT or minT
+        self.stableCount = 0    # calls without change since the last change.
+
+    def update(self, changed):
+        """ Update with the result of the last call, return the new period."""
+        if changed:
+            self.boost()
+        else:
+            self.stableCount += 1
+            if self.stableCount >= self.hold:
+                self.period = min(self.maxT, self.period*self.backoff)
+        return self.period
+
+    def boost(self):
+        """ Switch to the min period (e.g. a change is expected), return it."""
+        self.period = self.minT
+        self.stableCount = 0
+        return self.period
+
+    def toDict(self):
+        return {'period': self.period,
+                'rate': round(1.0/self.period, 3),
+                'min': self.minT,
+                'max': self.maxT}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class loopScheduler(object):
+    """ Fixed rate scheduler running the periodic tasks in the caller's thread.
+        The n-th tick is due at startT + n*tick, if a cycle overruns the missed
+        ticks are skipped (no burst of catch-up calls) and counted.
+        init example: sched = loopScheduler(1); sched.addTask('poll', func, 1)
+                      sched.run(keepRun=lambda: True)
+    """
+    def __init__(self, tick=TICK_INT, debug=False):
+        self.tick = tick
+        self.debug = debug
+        self.tasks = []         # periodicTask list, called in the adding order.
+        self.jitter = timeStats()   # tick start lateness after the deadline.
+        self.cycle = timeStats()    # time used by the tasks of each tick.
+        self.overrunCount = 0   # ticks which used more than the tick period.
+        self.missedTicks = 0    # ticks skipped due to the overruns.
+        self.deadline = None    # monotonic deadline of the next tick.
+        self.terminate = threading.Event()
+        self.resumeEvt = threading.Event()  # cleared while the pausable tasks are paused.
+        self.resumeEvt.set()
+        self.pauseLock = threading.Lock()
+
+#-----------------------------------------------------------------------------
+    def addTask(self, name, func, period=None, budget=None, pausable=False):
+        """ Add a task called every <period> sec (rounded to the ticks, default
+            every tick). Return the periodicTask.
+        """
+        task = periodicTask(name, func, period or self.tick, budget, pausable)
+        self.tasks.append(task)
+        return task
+
+#-----------------------------------------------------------------------------
+    def getTask(self, name):
+        """ Return the periodicTask with the name or None."""
+        for task in self.tasks:
+            if task.name == name: return task
+        return None
+
+#-----------------------------------------------------------------------------
+    def setPeriod(self, name, period):
+        """ Change the period of a task, the new period starts from its last
+            call deadline (the task can change its own period when called).
+        """
+        task = self.getTask(name)
+        if task is None: return
+        task.period = period
+        if task.lastT is not None: task.nextT = task.lastT + period
+
+#-----------------------------------------------------------------------------
+    def pause(self):
+        """ Pause the pausable tasks. Return False if they are already paused,
+            so the caller can use it to claim the pause.
+        """
+        with self.pauseLock:
+            if not self.resumeEvt.is_set(): return False
+            self.resumeEvt.clear()
+            return True
+
+    def resume(self):
+        """ Resume the pausable tasks."""
+        with self.pauseLock:
+            self.resumeEvt.set()
+
+    def isPaused(self):
+        return not self.resumeEvt.is_set()
+
+#-----------------------------------------------------------------------------
+    def runTick(self, tickT):
+        """ Call the tasks due at the tick deadline <tickT>."""
+        paused = self.isPaused()
+        for task in self.tasks:
+            if task.nextT is None: task.nextT = tickT
+            if task.nextT > tickT + PERIOD_TOL: continue
+            if paused and task.pausable:
+                task.lastT, task.nextT = None, tickT + task.period # resume at the next period.
+                continue
+            task.lastT = task.nextT
+            startT = time.monotonic()
+            try:
+                task.func()
+            except Exception as err:
+                task.errCount += 1
+                print("loopScheduler: task %s error: %s" % (task.name, str(err)))
+            duration = time.monotonic() - startT
+            task.duration.add(duration)
+            if duration > task.budget: task.overrunCount += 1
+            # Fixed rate: the next deadline is counted from the due time.
+            task.nextT = task.lastT + task.period
+            now = time.monotonic()
+            if task.nextT < now - PERIOD_TOL:
+                missed = int((now - task.nextT)//task.period) + 1
+                task.missedCount += missed
+                task.nextT += missed*task.period
+
+#-----------------------------------------------------------------------------
+    def run(self, keepRun=None):
+        """ Run the ticks until stop() is called or keepRun() returns False."""
+        self.terminate.clear()
+        self.deadline = time.monotonic()
+        while not self.terminate.is_set() and (keepRun is None or keepRun()):
+            if self.isPaused() and all(task.pausable for task in self.tasks):
+                # Nothing to run: sleep until resumed (wake up every tick to
+                # check the stop conditions), then restart the ticks from now.
+                if self.resumeEvt.wait(self.tick):
+                    self.deadline = time.monotonic()
+                    for task in self.tasks: task.nextT = task.lastT = None
+                continue
+            delay = self.deadline - time.monotonic()
+            if delay > 0 and self.terminate.wait(delay): break
+            startT = time.monotonic()
+            self.jitter.add(startT - self.deadline)
+            self.runTick(self.deadline)
+            endT = time.monotonic()
+            self.cycle.add(endT - startT)
+            self.deadline += self.tick
+            if endT > self.deadline + PERIOD_TOL:
+                # Cycle missed its budget, skip the ticks which are already late.
+                missed = int((endT - self.deadline)//self.tick) + 1
+                self.overrunCount += 1
+                self.missedTicks += missed
+                self.deadline += missed*self.tick
+                print("loopScheduler: cycle overrun %.3f sec, %s tick(s) skipped."
+                      % (endT - startT, missed))
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the run() loop."""
+        self.terminate.set()
+        self.resumeEvt.set()
+
+#-----------------------------------------------------------------------------
+    def getStats(self):
+        """ Return the scheduler statistics dict (times in ms)."""
+        return {'tick': self.tick,
+                'paused': self.isPaused(),
+                'jitter': self.jitter.toDict(),
+                'cycle': self.cycle.toDict(),
+                'overrun': self.overrunCount,
+                'missed': self.missedTicks,
+                'tasks': {task.name: task.toDict() for task in self.tasks}}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        print("Run 3 tasks on a 0.1 sec tick for 2 sec:")
+        sched = loopScheduler(0.1)
+        sched.addTask('fast', lambda: time.sleep(0.02))
+        sched.addTask('slow', lambda: time.sleep(0.05), 0.5)
+        sched.addTask('late', lambda: time.sleep(0.15), 1)
+        threading.Timer(2, sched.stop).start()
+        sched.run()
+        print(sched.getStats())
+    elif mode == 1:
+        print("Pause the pausable task for 1 sec:")
+        sched = loopScheduler(0.1)
+        sched.addTask('poll', lambda: print("poll %.2f" % time.monotonic()), pausable=True)
+        threading.Timer(0.3, sched.pause).start()
+        threading.Timer(1.3, sched.resume).start()
+        threading.Timer(1.6, sched.stop).start()
+        sched.run()
+    elif mode == 2:
+        print("Adaptive period: 2 changes then stable:")
+        rate = adaptivePeriod(0.25, 4)
+        print([rate.update(changed) for changed in (1, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)])
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
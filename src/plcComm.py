@@ -0,0 +1,462 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        plcComm.py
+#
+# Purpose:     This module provides the common helper functions and classes
+#              used by the PLC drivers: a TCP connect reachability probe, a
+#              background probe scheduler which checks all the configured PLCs
+#              in parallel and caches their reachability state, the shadow
+#              image of the PLC memory used to skip the redundant writes, a
+#              background reconnect manager with per device exponential backoff,
+#              the parallel device readiness wait used at the start up, the
+#              common I/O deadline and error classification policy of all the
+#              PLC drivers and the per device circuit breaker which fast-fails
+#              the requests to a device which keeps timing out.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/15
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import time
+import random
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PROBE_TIMEOUT = 0.5 # TCP connect probe deadline (sec).
+PROBE_INT = 2       # time interval between 2 rounds of background probing (sec).
+CONN_TIMEOUT = 2    # PLC connection establish deadline (sec).
+IO_TIMEOUT = 1      # deadline of one PLC request (send + response) (sec).
+READY_TIMEOUT = 40  # start up deadline of the devices readiness wait (sec).
+READY_INT = 1       # time interval between 2 readiness checks of a device (sec).
+RECONN_INT = 0.5    # reconnect manager check interval (sec).
+RECONN_MIN = 1      # first reconnect backoff (sec).
+RECONN_MAX = 30     # max reconnect backoff (sec).
+RECONN_JITTER = 0.2 # backoff random jitter ratio (+/-).
+BREAKER_FAILS = 3   # consecutive failed requests which open the circuit breaker.
+BREAKER_RESET = 5   # time the breaker stays open before the half-open probe (sec).
+
+# Reconnect manager device states.
+ST_UP = 'up'
+ST_DOWN = 'down'
+ST_CONN = 'connecting'
+
+# Circuit breaker states.
+BR_CLOSED = 'closed'
+BR_OPEN = 'open'
+BR_HALF = 'half-open'
+
+#-----------------------------------------------------------------------------
+class PlcIOError(Exception):
+    """ PLC request failed. The timeout and reset errors mean the connection
+        is not usable any more, a protocol error only fails the request.
+    """
+
+class PlcTimeoutError(PlcIOError):
+    """ The PLC did not answer the request before its deadline."""
+
+class PlcResetError(PlcIOError):
+    """ The connection to the PLC was reset, refused or closed."""
+
+class PlcProtocolError(PlcIOError):
+    """ The PLC answered with an error or an invalid response."""
+
+class CircuitOpenError(PlcIOError):
+    """ The request is rejected at once as the device's circuit breaker is open."""
+
+TIMEOUT_HINTS = ('timeout', 'timed out')
+RESET_HINTS = ('reset', 'refused', 'broken pipe', 'closed', 'connection', 'not connected')
+
+#-----------------------------------------------------------------------------
+def classifyError(err):
+    """ Return the PlcIOError subclass instance of a driver exception: the 
+        socket errors are classified by type, the snap7 errors (which differ
+        between the python-snap7 versions) by their message.
+    """
+    if isinstance(err, PlcIOError): return err
+    if isinstance(err, (socket.timeout, TimeoutError)):
+        return PlcTimeoutError(str(err) or 'request timeout')
+    if isinstance(err, OSError): return PlcResetError(str(err))
+    msg = ('%s %s' % (type(err).__name__, err)).lower()
+    if any(hint in msg for hint in TIMEOUT_HINTS): return PlcTimeoutError(str(err))
+    if any(hint in msg for hint in RESET_HINTS): return PlcResetError(str(err))
+    return PlcProtocolError(str(err))
+
+#-----------------------------------------------------------------------------
+def isConnError(err):
+    """ Return True if the (classified) error means the connection is lost."""
+    return isinstance(err, (PlcTimeoutError, PlcResetError))
+
+#-----------------------------------------------------------------------------
+def tcpProbe(host, port, timeout=PROBE_TIMEOUT):
+    """ Return True if a TCP connection to (host, port) can be established in
+        <timeout> seconds. Used instead of the ICMP ping as a PLC may not answer
+        a ping and forking a ping process for each check is slow.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+#-----------------------------------------------------------------------------
+def waitReady(checkDict, timeout=READY_TIMEOUT, interval=READY_INT):
+    """ Run the devices' readiness checks {name: check()->bool} in parallel, a
+        check is repeated every <interval> sec until it returns True or the 
+        overall <timeout> deadline passes, a check returning None gives up at 
+        once (e.g. the device is not attached). Return the {name: ready} dict
+        as soon as all the devices are ready or given up (or the deadline passed).
+    """
+    deadline = time.monotonic() + timeout
+    def waitOne(check):
+        while True:
+            try:
+                ready = check()
+                if ready: return True
+                if ready is None: return False
+            except Exception as err:
+                print("waitReady: check error: %s" % str(err))
+            remain = deadline - time.monotonic()
+            if remain <= 0: return False
+            time.sleep(min(interval, remain))
+    with ThreadPoolExecutor(max_workers=max(1, len(checkDict))) as pool:
+        futures = {name: pool.submit(waitOne, check) for name, check in checkDict.items()}
+        return {name: ft.result() for name, ft in futures.items()}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class probeScheduler(threading.Thread):
+    """ Thread to probe all the devices in parallel every <interval> seconds and
+        cache the result, the reachability state can be read without blocking.
+        init example: prober = probeScheduler(None, {'plc1': ('192.168.10.72', 502)})
+    """
+    def __init__(self, parent, devDict, interval=PROBE_INT, timeout=PROBE_TIMEOUT):
+        threading.Thread.__init__(self, daemon=True)
+        self.parent = parent
+        self.devDict = dict(devDict)    # {device name: (ip, port)}
+        self.interval = interval
+        self.timeout = timeout
+        self.stateDict = {name: False for name in self.devDict}  # cached reachability.
+        self.lastProbe = None           # time.monotonic() of the last probe round.
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.devDict)))
+        self.terminate = threading.Event()
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Probe all the devices periodically until stop() is called."""
+        while not self.terminate.is_set():
+            self.probeAll()
+            self.terminate.wait(self.interval)
+        self.executor.shutdown(wait=False)
+
+#-----------------------------------------------------------------------------
+    def probeAll(self):
+        """ Probe all the devices in parallel, update and return the state dict."""
+        futures = {name: self.executor.submit(tcpProbe, ip, port, self.timeout)
+                   for name, (ip, port) in self.devDict.items()}
+        self.stateDict = {name: ft.result() for name, ft in futures.items()}
+        self.lastProbe = time.monotonic()
+        return self.stateDict
+
+#-----------------------------------------------------------------------------
+    def isReachable(self, name):
+        """ Return the cached reachability state of device <name>."""
+        return self.stateDict.get(name, False)
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the probe thread."""
+        self.terminate.set()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class shadowImage(object):
+    """ Shadow image of a PLC memory area: the last bit states confirmed by a 
+        read response or an acknowledged write. Each bit is unknown until it 
+        is confirmed. Addresses outside the image are ignored.
+    """
+    def __init__(self, size):
+        self.size = size                # image size in bytes.
+        self.data = bytearray(size)     # bit values.
+        self.known = bytearray(size)    # confirmed bits mask.
+        self.lock = threading.Lock()
+        self.updateT = None             # time.monotonic() of the last update.
+
+    def setBits(self, addr, bits):
+        """ Confirm the bit values list <bits> from bit address <addr>."""
+        with self.lock:
+            for i, val in enumerate(bits):
+                idx, bit = divmod(addr + i, 8)
+                if idx >= self.size: break
+                if val:
+                    self.data[idx] |= 1 << bit
+                else:
+                    self.data[idx] &= ~(1 << bit) & 0xFF
+                self.known[idx] |= 1 << bit
+            self.updateT = time.monotonic()
+
+    def setBytes(self, start, data):
+        """ Confirm all the bits of the bytes from byte index <start>."""
+        with self.lock:
+            data = data[:max(0, self.size - start)]
+            self.data[start:start+len(data)] = data
+            self.known[start:start+len(data)] = b'\xff'*len(data)
+            self.updateT = time.monotonic()
+
+    def getBit(self, addr):
+        """ Return the bit value 0/1 or None if the bit is unknown."""
+        idx, bit = divmod(addr, 8)
+        if idx >= self.size or not (self.known[idx] >> bit) & 1: return None
+        return (self.data[idx] >> bit) & 1
+
+    def getBytes(self, start, count):
+        """ Return the bytes if all their bits are confirmed, else None."""
+        with self.lock:
+            if start + count > self.size or any(b != 0xFF for b in self.known[start:start+count]):
+                return None
+            return bytes(self.data[start:start+count])
+
+    def changed(self, addr, val):
+        """ Return True if writing <val> to bit <addr> may change the PLC state."""
+        return self.getBit(addr) != (int(val) & 1)
+
+    def clear(self):
+        """ Forget all the bits (e.g. after the connection is lost)."""
+        with self.lock:
+            self.known[:] = bytes(self.size)
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class reconnManager(threading.Thread):
+    """ Background reconnect manager: checks the devices every <interval> sec
+        and reconnects the dead ones in parallel on a thread pool. A failed
+        attempt doubles the device's backoff (with jitter) up to maxT. A new
+        connection only clears the failure count once the device answered a
+        real request (confirmUp()), so a device which accepts the connections
+        but never answers is retried with a growing backoff. The callbacks:
+            isUp(name) -> bool: the current device connection is alive.
+            connect(name) -> obj: create and connect a new device object.
+            swap(name, obj): replace the dead device object with the new one.
+        init example: mgr = reconnManager(None, ('plc1', 'plc2'), isUp, connect, swap)
+    """
+    def __init__(self, parent, devNames, isUp, connect, swap, prober=None, 
+                 interval=RECONN_INT, minT=RECONN_MIN, maxT=RECONN_MAX, jitter=RECONN_JITTER):
+        threading.Thread.__init__(self, name='reconnect manager', daemon=True)
+        self.parent = parent
+        self.isUp = isUp
+        self.connect = connect
+        self.swap = swap
+        self.prober = prober    # skip the attempts while the probe fails.
+        self.interval = interval
+        self.minT = minT
+        self.maxT = maxT
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.devStates = {name: {'state': ST_DOWN, 'fails': 0, 'backoff': 0, 'confirmed': False,
+                                 'nextT': time.monotonic() + minT, 'error': None}
+                          for name in devNames}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, len(self.devStates)))
+        self.terminate = threading.Event()
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Check the devices periodically until stop() is called."""
+        while not self.terminate.wait(self.interval):
+            self.checkAll()
+        self.executor.shutdown(wait=False)
+
+#-----------------------------------------------------------------------------
+    def checkAll(self):
+        """ Update the device states and start the due reconnect attempts."""
+        now = time.monotonic()
+        for name, devState in self.devStates.items():
+            with self.lock:
+                if devState['state'] == ST_CONN: continue
+                if self.isUp(name):
+                    devState['state'] = ST_UP
+                    continue
+                if devState['state'] == ST_UP:
+                    if not devState['confirmed']:
+                        # Lost before any request was answered: back off.
+                        self._failed(devState, 'no response')
+                    else:
+                        # Confirmed connection just lost: retry at once.
+                        devState.update(state=ST_DOWN, nextT=now)
+                if now < devState['nextT']: continue
+                if self.prober and not self.prober.isReachable(name):
+                    self._failed(devState, 'unreachable')
+                    continue
+                devState['state'] = ST_CONN
+            self.executor.submit(self._reconnect, name)
+
+#-----------------------------------------------------------------------------
+    def _reconnect(self, name):
+        """ Try one reconnect of the device (runs on the thread pool)."""
+        devState = self.devStates[name]
+        try:
+            obj = self.connect(name)
+        except Exception as err:
+            obj, error = None, str(err)
+        else:
+            error = None if obj is not None and obj.connected else 'connect failed'
+        with self.lock:
+            if error is None:
+                self.swap(name, obj)
+                devState.update(state=ST_UP, confirmed=False)  # fails kept until confirmUp().
+                print("reconnManager: %s reconnected." % name)
+                return
+            self._failed(devState, error)
+        if obj is not None: obj.disconnect()   # release the socket.
+
+#-----------------------------------------------------------------------------
+    def _failed(self, devState, error):
+        """ Count a failed attempt and schedule the next one (lock held)."""
+        devState['fails'] += 1
+        backoff = min(self.maxT, self.minT * 2 ** (devState['fails'] - 1))
+        backoff *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        devState.update(state=ST_DOWN, backoff=round(backoff, 3), error=error,
+                        nextT=time.monotonic() + backoff)
+
+#-----------------------------------------------------------------------------
+    def confirmUp(self, name):
+        """ Clear the device's failure count and backoff after a request on its
+            connection succeeded.
+        """
+        with self.lock:
+            devState = self.devStates.get(name)
+            if devState and not devState['confirmed'] and devState['state'] == ST_UP:
+                devState.update(confirmed=True, fails=0, backoff=0, error=None)
+
+#-----------------------------------------------------------------------------
+    def getState(self, name=None):
+        """ Return the {name: state} dict (or the state of the device <name>)."""
+        with self.lock:
+            if name: return self.devStates[name]['state']
+            return {name: devState['state'] for name, devState in self.devStates.items()}
+
+#-----------------------------------------------------------------------------
+    def stop(self):
+        """ Stop the manager thread."""
+        self.terminate.set()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class circuitBreaker(object):
+    """ Per device circuit breaker: 
+            closed: the requests are sent, <failMax> consecutive failures (the
+                timeout/reset errors) open the breaker.
+            open: the requests fail fast (no device I/O) for <resetT> sec.
+            half-open: a single probe request is let through, its success 
+                closes the breaker, its failure opens it again.
+        The caller asks allow() before each request and reports the result
+        with success()/failure().
+        init example: breaker = circuitBreaker('plc1')
+    """
+    def __init__(self, name, failMax=BREAKER_FAILS, resetT=BREAKER_RESET):
+        self.name = name
+        self.failMax = failMax
+        self.resetT = resetT
+        self.lock = threading.Lock()
+        self.state = BR_CLOSED
+        self.fails = 0          # consecutive failures.
+        self.openT = None       # monotonic time the breaker was opened.
+        self.probing = False    # the half-open probe request is in progress.
+        self.openCount = 0      # times the breaker was opened.
+
+#-----------------------------------------------------------------------------
+    def ready(self):
+        """ Return True if a request would be let through now (doesn't claim 
+            the half-open probe), used to reject the requests before queueing.
+        """
+        with self.lock:
+            if self.state == BR_CLOSED: return True
+            if self.state == BR_OPEN: return time.monotonic() - self.openT >= self.resetT
+            return not self.probing
+
+#-----------------------------------------------------------------------------
+    def allow(self):
+        """ Return True if the request can be sent. After the open period the
+            first caller gets the half-open probe, the others are rejected 
+            until the probe result is reported.
+        """
+        with self.lock:
+            if self.state == BR_OPEN and time.monotonic() - self.openT >= self.resetT:
+                self.state, self.probing = BR_HALF, False
+            if self.state == BR_CLOSED: return True
+            if self.state == BR_HALF and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+#-----------------------------------------------------------------------------
+    def success(self):
+        """ Report a successful request: close the breaker."""
+        with self.lock:
+            if self.state != BR_CLOSED: print("circuitBreaker: %s closed." % self.name)
+            self.state, self.fails, self.probing = BR_CLOSED, 0, False
+
+#-----------------------------------------------------------------------------
+    def failure(self):
+        """ Report a failed request: open the breaker after failMax consecutive
+            failures or if the half-open probe failed.
+        """
+        with self.lock:
+            self.fails += 1
+            self.probing = False
+            if self.state == BR_HALF or (self.state == BR_CLOSED and self.fails >= self.failMax):
+                if self.state == BR_CLOSED: print("circuitBreaker: %s open." % self.name)
+                self.state, self.openT = BR_OPEN, time.monotonic()
+                self.openCount += 1
+
+#-----------------------------------------------------------------------------
+    def reset(self):
+        """ Force the breaker closed (a reconnect doesn't: the half-open probe
+            closes it once the new connection answers).
+        """
+        with self.lock:
+            self.state, self.fails, self.probing = BR_CLOSED, 0, False
+
+#-----------------------------------------------------------------------------
+    def getState(self):
+        """ Return the breaker state (an open breaker past its open period is 
+            reported as half-open).
+        """
+        with self.lock:
+            if self.state == BR_OPEN and time.monotonic() - self.openT >= self.resetT: return BR_HALF
+            return self.state
+
+#-----------------------------------------------------------------------------
+    def toDict(self):
+        return {'state': self.getState(), 'fails': self.fails, 'opened': self.openCount}
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        print("Probe the local host ports:")
+        prober = probeScheduler(None, {'local': ('127.0.0.1', 22),
+                                       'plc1': ('192.168.10.72', 502)}, interval=1)
+        prober.start()
+        time.sleep(2)
+        print(prober.stateDict)
+        prober.stop()
+    elif mode == 1:
+        print("Circuit breaker: 3 failures, fast-fail, half-open probe:")
+        breaker = circuitBreaker('plc1', resetT=0.5)
+        for _ in range(3): 
+            if breaker.allow(): breaker.failure()
+        print(breaker.getState(), breaker.allow())
+        time.sleep(0.6)
+        print(breaker.getState(), breaker.allow(), breaker.allow())
+        breaker.success()
+        print(breaker.toDict())
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
@@ -13,17 +13,23 @@
 #--------------------------------------------------------------------------
 
 import os
+import asyncio
 import time
 import json
-import re
 import csv
-import _thread      # python2's built in 'thread' is changed to '_thread' in python3
 import threading    # create multi-thread test case.
+from concurrent import futures
 from random import randint
+from functools import partial
 
 import udpCom
 import tcpCom
 import serialCom
+import plcComm
+import devDriver
+import loopSched
+import scenarioEng
+import stateStore
 import BgCtrl as bg
 import M2PLC221 as m221
 import S7PLC1200 as s71200
@@ -33,11 +39,23 @@ APP_NAME = "pwrGenMgr"
 UDP_PORT = 5005
 TCP_PORT = 5009     # set to None if don't want tranfer data under modebus
 TEST_MODE = True   # Local test mode flag.
-TIME_INT = 1        # time interval to fetch the load.
+TIME_INT = 0.25     # time interval of the main loop ticks.
+LOAD_POLL_INT = 1   # initial time interval to fetch the load.
+POLL_MIN_INT = 0.25 # load fetch interval while the loads are changing.
+POLL_MAX_INT = 4    # load fetch interval limit while the loads are stable.
+AUTO_CTRL_INT = 1   # time interval of the generator auto control.
+PLC_RD_TIMEOUT = plcComm.IO_TIMEOUT + 0.2 # deadline of one PLC load state read (>= the driver I/O deadline).
 PLC1_IP = '192.168.10.72'
 PLC2_IP = '192.168.10.73'
 PLC3_IP = '192.168.10.71'
+PLC1_PORT = m221.PLC_PORT   # set to the M221Sim port when testing without the PLCs.
+PLC2_PORT = s71200.PLC_PORT # set to the S7Sim port when testing without the PLCs.
+PLC3_PORT = m221.PLC_PORT
 CSV_VAL = 'pwrSubParm.csv'
+# Attack scenario timeline files in the scenarioEng.SCN_DIR folder.
+ATK_SCN = {'A;1': 'atkA1.json', 'A;3': 'atkA3.json'}
+ATK_STOP_TIMEOUT = 2  # max time to wait for the current scenario action to finish.
+SCN_FLAGS = ('autoCtrl', 'stSubAtkFlag') # manager attributes the scenario can set.
 
 # PLC output connection map table:
 # PLC 0 [schneider M221]: 
@@ -54,7 +72,48 @@ CSV_VAL = 'pwrSubParm.csv'
 #   M20 -> Q0.2 track B pwr
 #   M60 -> Q0.3 city LED
 #   M50 -> All power down.
-    
+
+# S7-1200 [PLC2] address handles, compiled (and validated) when the module is loaded.
+S7_ADDR = {tag: s71200.compileAddr(tag) for tag in ('qb0', 'qx0.0', 'qx0.2', 'qx0.3', 'qx0.4')}
+# PLC2 addresses read by one snapshot request in each poll cycle.
+S7_SNAP_TAGS = (S7_ADDR['qx0.0'], S7_ADDR['qx0.2'], S7_ADDR['qx0.3'], S7_ADDR['qx0.4'])
+
+# Load state decoder table: load -> (device, byte offset, bit mask, polarity).
+# The byte offset is the index in the raw PLC data bytes, polarity 1: the load
+# is on when the bit is set, 0: the load is on when the bit is cleared.
+LOAD_DECODER = {'Indu': ('plc1', 7, 0x10, 0),  # M60 off -> Industry area on
+                'Airp': ('plc1', 1, 0x04, 1),  # M10 on -> Air port on
+                'Resi': ('plc2', 0, 0x04, 0),  # Qx0.2 off -> Residential area on
+                'Stat': ('plc2', 0, 0x01, 1),  # Qx0.0 on -> Station power on
+                'TrkA': ('plc3', 1, 0x04, 1),  # M10 on -> Track A power on
+                'TrkB': ('plc3', 2, 0x10, 1),  # M20 on -> Track B power on
+                'City': ('plc3', 7, 0x10, 0),  # M60 off -> City power on
+                }
+
+# SetPLC request table: parameter -> value -> {device: {tag: value}}. The
+# Mpwr/Spwr values other than 'on' are taken as 'off'.
+PLC_SET_MAP = {
+    # Main power: airport, power plant, industry [plc1], station, resident 
+    # [plc2], track A, city [plc3].
+    'Mpwr': {'on': {'plc1': {'M0': 1, 'M10': 1, 'M60': 0},
+                    'plc2': {'qx0.0': True, 'qx0.2': False},
+                    'plc3': {'M10': 1, 'M60': 0}},
+             'off': {'plc1': {'M0': 0, 'M10': 0, 'M60': 1},
+                     'plc2': {'qx0.0': False, 'qx0.2': True},
+                     'plc3': {'M10': 0, 'M60': 1}}},
+    # TrackA and B all sensor power plc3 [M4, M5]. 00-off, 11-on.
+    'Spwr': {'on': {'plc3': {'M4': 1, 'M5': 1}},
+             'off': {'plc3': {'M4': 0, 'M5': 0}}},
+    # Generator pump speed plc1 [M4, M5]. 00-off, 01-low, 10-high.
+    'Pspd': {'off': {'plc1': {'M4': 0, 'M5': 0}},
+             'low': {'plc1': {'M4': 0, 'M5': 1}},
+             'high': {'plc1': {'M4': 1, 'M5': 0}}},
+    # Generator moto speed plc2 [Q3, Q4]. FF-off, FT-low, TF-high.
+    'Mspd': {'off': {'plc2': {'qx0.3': False, 'qx0.4': False}},
+             'low': {'plc2': {'qx0.3': False, 'qx0.4': True}},
+             'high': {'plc2': {'qx0.3': True, 'qx0.4': False}}},
+}
+
 #--------------------------------------------------------------------------
 #--------------------------------------------------------------------------
 class pwrGenClient(object):
@@ -68,21 +127,62 @@ class pwrGenClient(object):
         self.loadNum = 0        # number of loads.
         self.autoCtrl = False   # generator auto control based on load number.
         self.debug = debug      # debug mode flag.
-        self.atkLocker = False  # lock the new incoming attack request if doing attack simulation.
         self.stSubAtkFlag  = 0  # Stealthy substation attack active flag 0 normal case, 1 under attack.
         self.mainPwrSet = False # Wheter we need to set/update main power in the next around of loop.  
         self.mainPwrStr = 'on'  # Main power set string 'on'/'off'
-
-        # try to connect to the arduino by serial port.
-        self.serialComm = serialCom.serialCom(None, baudRate=115200)
-        print("func[__init__]: Parameters inited, wait 30 sec make sure PLCs oneline.")
-        time.sleep(40) # wait 40 second to make sure all the PLCs are online already
-        # try to connect to the PLCs.
-        # ping the IP address first.
-        self.plc1 = m221.M221(PLC1_IP)
-        self.plc2 = s71200.S7PLC1200(PLC2_IP)
-        self.plc3 = m221.M221(PLC3_IP)
-        self.reConnectCount = 0 if self.plc1.connected and self.plc2.connected and self.plc3.connected else 10
+        self.atkRunner = None   # running attack scenarioEng.scenarioRunner.
+
+        # Wait (up to plcComm.READY_TIMEOUT) until the PLCs accept connections
+        # and the arduino serial port is opened, all the devices are checked in
+        # parallel. The serial port wait stops if no port is found.
+        self.serialComm = None
+        print("func[__init__]: Parameters inited, wait for the PLCs and Arduino ready.")
+        readyDict = plcComm.waitReady({'plc1': partial(plcComm.tcpProbe, PLC1_IP, PLC1_PORT),
+                                       'plc2': partial(plcComm.tcpProbe, PLC2_IP, PLC2_PORT),
+                                       'plc3': partial(plcComm.tcpProbe, PLC3_IP, PLC3_PORT),
+                                       'gen': self._openSerial})
+        notReady = [name for name, ready in readyDict.items() if not ready]
+        if notReady: print("func[__init__]: start in degraded mode, not ready: %s" %str(notReady))
+        # try to connect to the PLCs in parallel, the reconnect manager will 
+        # retry the failed ones.
+        with futures.ThreadPoolExecutor(max_workers=3) as pool:
+            plcFts = [pool.submit(self._createPlc, plcName) for plcName in ('plc1', 'plc2', 'plc3')]
+            self.plc1, self.plc2, self.plc3 = [future.result() for future in plcFts]
+        # One I/O actor per device serializes all the device calls by priority,
+        # the PLCs' load state are read in parallel by their actors. A PLC which
+        # keeps failing opens its circuit breaker: the polls and the operator
+        # commands then fail fast instead of waiting for its timeouts.
+        # The half-open probe is a load state read, it always reaches the PLC.
+        self.breakers = {plcName: plcComm.circuitBreaker(plcName) for plcName in ('plc1', 'plc2', 'plc3')}
+        self.actors = {plcName: devDriver.devActor(plcName, partial(getattr, self, plcName), 
+                                                   breaker=self.breakers[plcName],
+                                                   probe=partial(self._probeLoadData, plcName=plcName))
+                       for plcName in ('plc1', 'plc2', 'plc3')}
+        self.actors['gen'] = devDriver.devActor('gen', lambda: self.serialComm)
+        for actor in self.actors.values(): actor.start()
+        self.pollFutures = {}   # the load read future of each PLC not used yet.
+        self.plcLoadMasks = {}  # last known loads bitmask of each PLC.
+        self.loadDecoder = loadDecoder(LOAD_DECODER)
+        self.setPlanner = plcSetPlanner(PLC_SET_MAP)
+        self.lastLoadMask = None    # loads bitmask of the last poll.
+        # Load poll period: fast while the loads change or a scenario runs.
+        self.pollRate = loopSched.adaptivePeriod(POLL_MIN_INT, POLL_MAX_INT, initT=LOAD_POLL_INT)
+        # Asyncio device drivers, all run on one event loop thread.
+        self.ioLoop = devDriver.loopThread()
+        self.ioLoop.start()
+        self.drivers = {'plc1': devDriver.m221Driver(lambda: self.plc1, actor=self.actors['plc1']),
+                        'plc2': devDriver.s7Driver(lambda: self.plc2, actor=self.actors['plc2']),
+                        'plc3': devDriver.m221Driver(lambda: self.plc3, actor=self.actors['plc3']),
+                        'gen': devDriver.serialDriver(lambda: self.serialComm, actor=self.actors['gen'])}
+        # Background PLC reachability prober, the reconnect manager only retries the reachable PLCs.
+        self.prober = plcComm.probeScheduler(self, {'plc1': (PLC1_IP, PLC1_PORT),
+                                                    'plc2': (PLC2_IP, PLC2_PORT),
+                                                    'plc3': (PLC3_IP, PLC3_PORT)})
+        # Background PLC reconnect manager, a dead PLC is reconnected with its
+        # own exponential backoff while the others are polled.
+        self.reconnMgr = plcComm.reconnManager(self, ('plc1', 'plc2', 'plc3'), 
+                                               lambda plcName: getattr(self, plcName).connected,
+                                               self._createPlc, self._swapPlc, prober=self.prober)
         # Init the UDP server.
         # self.server = udpCom.udpServer(None, UDP_PORT)
         self.servThread = CommThreadUDP(self, 0, "UDP server thread")
@@ -90,6 +190,19 @@ class pwrGenClient(object):
         if TCP_PORT: self.mdBusThread = CommThreadTCP(self, 1, "TCP server thread")
         # Init the state information manager.
         self.stateMgr = stateManager()
+        # Deadline based main loop scheduler, the loop period doesn't drift with
+        # the I/O time. The PLC control tasks are paused while an attack is 
+        # simulated: scheduler.pause() also locks the new incoming attack 
+        # requests. The load poll goes on (at the fast rate) so the attack
+        # effects are shown, its reads are queued behind the scenario writes.
+        self.scheduler = loopSched.loopScheduler(TIME_INT)
+        if TEST_MODE:
+            # Local simulation mode test:
+            self.scheduler.addTask('loadSim', self._simLoadTask, LOAD_POLL_INT)
+        else:
+            self.scheduler.addTask('mainPwr', self._mainPwrTask)
+            self.scheduler.addTask('loadPoll', self._loadPollTask, LOAD_POLL_INT)
+        self.scheduler.addTask('autoCtrl', self._autoCtrlTask, AUTO_CTRL_INT, pausable=not TEST_MODE)
         # Power generator nit the platform state:
         if self.serialComm and self.serialComm.connected and not TEST_MODE:
             self.setGenState("50.00:11.00:green:green:green:green:slow:off")
@@ -104,29 +217,18 @@ class pwrGenClient(object):
     def mainLoop(self):
         """ Controler request handling loop."""
         print("echo-servers start.")
+        self.prober.start()
+        self.reconnMgr.start()
         self.servThread.start()
         if TCP_PORT: self.mdBusThread.start()
         print("Manager main loop start.")
-        while self.bgCtrler.bgRun():
-            if TEST_MODE:
-                # Local simulation mode test:
-                self.loadNum = randint(0,3)
-            else:
-                if self.mainPwrSet:
-                    self.setMainPwr(self.mainPwrStr)
-                    self.mainPwrSet = False
-                if self.atkLocker:continue # dont change the plc when attack is happening
-                self.loadNum = self.stateMgr.getLoadNum()
-                self.getLoadState()
-                # Try reconnect to the PLC if we are in real mode.
-                if self.reConnectCount > 0:
-                    print(">>> reconnect PLC in %s sec" %str(self.reConnectCount))
-                    if self.reConnectCount == 1: self.plcReconnect() # Do the reconnect
-                    self.reConnectCount -= 1
-            self.autoCtrlGen(self.loadNum) # get the load number.
-            time.sleep(TIME_INT)
-        
+        self.scheduler.run(keepRun=self.bgCtrler.bgRun)
+
         # Stop the program and disconnect all the connection.
+        self.prober.stop()
+        self.reconnMgr.stop()
+        for actor in self.actors.values(): actor.stop()
+        self.ioLoop.stop()
         self.servThread.stop()
         self.servThread = None
         if self.serialComm: self.serialComm.close()
@@ -136,24 +238,57 @@ class pwrGenClient(object):
         print("Power generator main loop end.")
 
 #--------------------------------------------------------------------------
-    def plcReconnect(self):
-        """ Try to reconnect the PLC if the plc is not connect."""
-        if not self.plc1.connected:
-            print("Try to reconnect to PLC1: %s" %str(PLC1_IP))
-            self.plc1.disconnect()  # disconnect to release the socket.
-            self.plc1 = m221.M221(PLC1_IP)
-            time.sleep(0.1)
+    def _simLoadTask(self):
+        """ Local test mode: simulate a random load number."""
+        self.loadNum = randint(0,3)
 
-        if not self.plc2.connected:
-            print("Try to reconnect to PLC2: %s" %str(PLC2_IP))
-            self.plc2.disconnect()  # disconnect to release the socket.
-            self.plc2 = s71200.S7PLC1200(PLC2_IP)
-            time.sleep(0.1)
+#--------------------------------------------------------------------------
+    def _mainPwrTask(self):
+        """ Set/update the main power if requested."""
+        if self.mainPwrSet:
+            self.setMainPwr(self.mainPwrStr)
+            self.mainPwrSet = False
 
-        if not self.plc3.connected:     
-            print("Try to reconnect to PLC3: %s" %str(PLC3_IP))
-            self.plc3.disconnect()  # disconnect to release the socket.
-            self.plc3 = m221.M221(PLC3_IP)
+#--------------------------------------------------------------------------
+    def _loadPollTask(self):
+        """ Fetch the load state from the PLCs and adapt the poll period."""
+        self.loadNum = self.stateMgr.getLoadNum()
+        changed = self.getLoadState()
+        scnRunning = self.atkRunner is not None and self.atkRunner.is_alive()
+        self.scheduler.setPeriod('loadPoll', self.pollRate.update(changed or scnRunning))
+
+#--------------------------------------------------------------------------
+    def _autoCtrlTask(self):
+        """ Control the generator based on the load number."""
+        self.autoCtrlGen(self.loadNum) # get the load number.
+
+#--------------------------------------------------------------------------
+    def _createPlc(self, plcName):
+        """ Create and connect the PLC object."""
+        if plcName == 'plc1': return m221.M221(PLC1_IP, port=PLC1_PORT)
+        if plcName == 'plc3': return m221.M221(PLC3_IP, port=PLC3_PORT)
+        plc = s71200.S7PLC1200(PLC2_IP, port=PLC2_PORT)
+        plc.registerTags(S7_SNAP_TAGS)
+        return plc
+
+#--------------------------------------------------------------------------
+    def _openSerial(self):
+        """ Try to connect to the arduino by serial port, return True if opened,
+            None if there is no serial port to retry (no arduino attached).
+        """
+        self.serialComm = serialCom.serialCom(None, baudRate=115200)
+        if not (self.serialComm.connected or self.serialComm.portList): return None
+        return self.serialComm.connected
+
+#--------------------------------------------------------------------------
+    def _swapPlc(self, plcName, plc):
+        """ Replace the dead PLC object with the reconnected one (called by the 
+            reconnect manager), the actors pick up the new object at their next
+            request.
+        """
+        oldPlc = getattr(self, plcName)
+        setattr(self, plcName, plc)
+        oldPlc.disconnect()  # disconnect to release the socket.
 
 #--------------------------------------------------------------------------
     def mdBusHandler(self, msg):
@@ -198,8 +333,8 @@ class pwrGenClient(object):
         msgStr = msg.decode('utf-8')
         # Implement cyber attack start and stop.
         if msgStr == 'A;1' or msgStr == 'A;3':
-            if self.atkLocker: return None
-            _thread.start_new_thread(self.startAttack, (msgStr,))
+            if self.scheduler.isPaused(): return None
+            self.startAttack(msgStr)
             return None
         if msgStr == 'A;0':
             self.stopAttack()
@@ -214,7 +349,8 @@ class pwrGenClient(object):
                 fbDict = {'Serial': self.serialComm.connected,
                           'Plc1': (not self.plc1 is None) and self.plc1.connected,
                           'Plc2': (not self.plc2 is None) and self.plc2.connected,
-                          'Plc3': (not self.plc2 is None) and self.plc3.connected
+                          'Plc3': (not self.plc2 is None) and self.plc3.connected,
+                          'Breaker': {plcName: breaker.getState() for plcName, breaker in self.breakers.items()}
                           }
                 respStr = json.dumps(fbDict)
             elif msgDict['Parm'] == 'Gen':
@@ -223,6 +359,12 @@ class pwrGenClient(object):
             elif msgDict['Parm'] == 'Load':
                 
                 respStr = self.stateMgr.getLoadInfo()
+            elif msgDict['Parm'] == 'Poll':
+                # Current load poll rate.
+                respStr = json.dumps(self.pollRate.toDict())
+            elif msgDict['Parm'] == 'Sched':
+                # Main loop timing statistics.
+                respStr = json.dumps(self.scheduler.getStats())
             else:
                 print('msgHandler : can not handle the un-expect cmd: %s' %str(msgDict['Parm']))
         elif msgDict['Cmd'] == 'SetGen':
@@ -231,22 +373,12 @@ class pwrGenClient(object):
             # Send the control cmd to COMM if not under test mode.
             if self.serialComm.connected and (not TEST_MODE):
                 if self.debug: print('Write message <%s> to Ardurino' %msgStr)
-                self.serialComm.write(msgStr.encode('utf-8'))
+                self._devCall('gen', 'write', msgStr.encode('utf-8'))
             respStr = self.stateMgr.getGenInfo()
         elif msgDict['Cmd'] == 'SetPLC':
-            # PLC  set request.
-            # Main power
-            if 'Mpwr' in msgDict['Parm'].keys():
-                self.setMainPwr(msgDict['Parm']['Mpwr'])
-            # TrackA and B all sensor power
-            if 'Spwr' in msgDict['Parm'].keys():
-                self.setSensorPwr(msgDict['Parm']['Spwr'])
-            # Pump speed.
-            if 'Pspd' in msgDict['Parm'].keys():
-                self.setPumpSpeed(msgDict['Parm']['Pspd'])
-            # Moto speed.
-            if 'Mspd' in msgDict['Parm'].keys():
-                self.setMotoSpeed(msgDict['Parm']['Mspd'])
+            # PLC  set request: main power, TrackA and B all sensor power, pump 
+            # speed and moto speed are written to all the PLCs in parallel.
+            self.applyPlcSet(msgDict['Parm'])
             # Updaste the state manager
             self.stateMgr.updateGenPlcState(msgDict['Parm'])
             respStr = self.stateMgr.getGenInfo()
@@ -263,44 +395,109 @@ class pwrGenClient(object):
 
 #--------------------------------------------------------------------------
     def getLoadState(self):
-        """" Connect to PLC to get the current load state. <m221_plc_modbus.txt>"""
-        loadDict = {'Indu': 0,      # Industry area
-                    'Airp': 0,      # Air port
-                    'Resi': 0,      # Residential area
-                    'Stat': 0,      # Stataion power
-                    'TrkA': 0,      # Track A power
-                    'TrkB': 0,      # Track B power
-                    'City': 0,      # City power
-                    }
-        # get the PLC 1 state:
-        if self.plc1.connected:
-            try:
-                s1resp = re.findall('..', str(self.plc1.readMem())[-16:])
-                loadDict['Indu'] = 1 if s1resp[7] == '00' else 0
-                loadDict['Airp'] = 1 if s1resp[1] == '04' else 0
-            except Exception as err: 
-                print("PLC1[%s] data read error:\n%s" %(PLC1_IP, err))
-                self.plc1.connected = False
-        # get PLC 2 state:
-        if self.plc2.connected:
-            try:
-                loadDict['Resi'] = 0 if self.plc2.getMem('qx0.2') else 1
-                loadDict['Stat'] = 1 if self.plc2.getMem('qx0.0') else 0
-            except Exception as err:
-                print("PLC2[%s] data read error:\n%s" %(PLC2_IP, err))
-                self.plc2.connected = False
-        # get PLC 3 state
-        if self.plc3.connected:
+        """" Connect to the PLCs in parallel to get the current load state, the 
+            cycle time is bounded by the slowest PLC. The raw PLC data bytes are
+            decoded by the LOAD_DECODER table. <m221_plc_modbus.txt> Return True
+            if the load state changed since the last poll.
+        """
+        # Use the reads which finished after the last poll's deadline first.
+        for plcName, future in list(self.pollFutures.items()):
+            if future.done(): self._usePollResult(plcName, future)
+        for plcName in self.loadDecoder.devices:
+            # Don't queue a new read behind a PLC read which is still hanging.
+            if plcName in self.pollFutures: continue
+            self.pollFutures[plcName] = self.actors[plcName].submit(
+                self._readLoadData, plcName, priority=devDriver.PRI_POLL, timeout=PLC_RD_TIMEOUT)
+        deadline = time.monotonic() + PLC_RD_TIMEOUT
+        for plcName, future in list(self.pollFutures.items()):
             try:
-                s3resp = re.findall('..', str(self.plc3.readMem())[-16:])
-                loadDict['TrkA'] = 1 if s3resp[1] == '04' else 0
-                loadDict['TrkB'] = 1 if s3resp[2] == '10' else 0
-                loadDict['City'] = 1 if s3resp[7] == '00' else 0
-            except Exception as err:
-                print("PLC3[%s] data read error:\n%s" %(PLC3_IP, err))
-                self.plc3.connected = False
-        self.stateMgr.updateLoadPlcState(loadDict)
-        
+                future.result(timeout=max(0, deadline - time.monotonic()))
+            except futures.TimeoutError:
+                # Late read: kept for the next poll, a connected PLC keeps its
+                # last known loads meanwhile.
+                print("%s load state read timeout." %plcName.upper())
+                plc = getattr(self, plcName)
+                if plc is None or not plc.connected: self.plcLoadMasks[plcName] = 0
+                continue
+            except Exception:
+                pass    # the error is handled by _usePollResult().
+            self._usePollResult(plcName, future)
+        # Apply all the PLCs' load state in one update.
+        loadMask = 0    # loads on bitmask, the loads of a failed PLC are off.
+        for plcMask in self.plcLoadMasks.values(): loadMask |= plcMask
+        self.stateMgr.updateLoadPlcState(self.loadDecoder.toDict(loadMask))
+        changed, self.lastLoadMask = loadMask != self.lastLoadMask, loadMask
+        return changed
+
+#--------------------------------------------------------------------------
+    def _usePollResult(self, plcName, future):
+        """ Update the PLC's loads bitmask with the result of a done load read."""
+        del self.pollFutures[plcName]
+        try:
+            data = future.result()
+        except (devDriver.ActorTimeoutError, devDriver.ActorBusyError):
+            print("%s load state read timeout." %plcName.upper())
+            data = None
+        except plcComm.CircuitOpenError:
+            data = None     # sick PLC skipped, its state is in the 'Con' response.
+        except Exception as err:
+            print("%s load state read error: %s" %(plcName.upper(), str(err)))
+            data = None
+        if data:
+            self.plcLoadMasks[plcName] = self.loadDecoder.decode(plcName, data)
+            self.reconnMgr.confirmUp(plcName)   # the PLC answers the requests.
+        else:
+            self.plcLoadMasks[plcName] = 0
+
+#--------------------------------------------------------------------------
+    def refreshLoadState(self):
+        """ Update the load state from the PLCs' shadow images so an acknowledged
+            write is reflected before the next poll.
+        """
+        loadDict = {}
+        for plcName in self.loadDecoder.devices:
+            plc = getattr(self, plcName)
+            data = plc.shadowBytes() if plc.connected else None
+            if data:
+                loadMask = self.loadDecoder.decode(plcName, data)
+                loadDict.update(self.loadDecoder.toDict(loadMask, device=plcName))
+        if loadDict: self.stateMgr.updateLoadPlcState(loadDict)
+
+#--------------------------------------------------------------------------
+    def _readLoadData(self, plc, plcName):
+        """ Read the raw load state bytes of the PLC (called by the PLC actor): 
+            the %M coil bytes of the M221 or the Q output byte from the S7-1200
+            snapshot. Return None if failed.
+        """
+        try:
+            if isinstance(plc, m221.M221): return plc.readCoilBytes(0, m221.COIL_NUM)
+            if plc.refreshSnapshot(): return plc.snapshotBytes(S7_ADDR['qb0'])
+        except Exception as err:
+            err = plcComm.classifyError(err)
+            print("%s[%s] data read %s:\n%s" %(plcName.upper(), plc.ip, type(err).__name__, err))
+            # Only the timeout/reset errors mean the link is lost, the reconnect
+            # manager then re-creates the PLC object.
+            if plcComm.isConnError(err): plc.connected = False
+        return None
+
+#--------------------------------------------------------------------------
+    def _probeLoadData(self, plc, plcName):
+        """ Circuit breaker half-open probe: return True if the load read got
+            the PLC data.
+        """
+        return self._readLoadData(plc, plcName) is not None
+
+#--------------------------------------------------------------------------
+    def _devCall(self, devName, method, *args, priority=devDriver.PRI_OPER):
+        """ Call the device method through the device actor and wait for the 
+            result, return None if the call failed.
+        """
+        try:
+            return self.actors[devName].call(method, *args, priority=priority)
+        except Exception as err:
+            print("%s %s() error: %s" %(devName.upper(), method, str(err)))
+            return None
+
 #--------------------------------------------------------------------------
     def autoCtrlGen(self, loadCount):
         """"Auto adjust the gen based on the load number.
@@ -317,85 +514,65 @@ class pwrGenClient(object):
         sirenSt = 'off'
         color = 'red' if self.loadNum == 0 else 'green'
         msgStr = ':'.join((freqList[self.loadNum], '11.00', color, color, color, color, 'fast', sirenSt))
-        self.setGenState(msgStr)
+        self.setGenState(msgStr, priority=devDriver.PRI_AUTO)
         
+#--------------------------------------------------------------------------
+    def applyPlcSet(self, parmDict):
+        """ Apply the SetPLC request parameters: the changes are planned to one
+            batched write per PLC, the PLCs are written in parallel and the 
+            function returns when all of them are acknowledged. Return the 
+            {device: result} dict, the result is None if the PLC is not connected.
+        """
+        if 'Mpwr' in parmDict: self.autoCtrl = False
+        devPlan = self.setPlanner.plan(parmDict)
+        if not devPlan: return {}
+        # poll fast to catch the load changes.
+        self.scheduler.setPeriod('loadPoll', self.pollRate.boost())
+        devices = list(devPlan.keys())
+        results = self.ioLoop.runCoro(devDriver.gatherAll(
+            *[self.drivers[dev].batch(devPlan[dev]) for dev in devices])).result()
+        resultDict = dict(zip(devices, results))
+        for dev, result in resultDict.items():
+            if isinstance(result, Exception):
+                print("applyPlcSet: %s write error: %s" %(dev.upper(), str(result)))
+            elif result is None and self.debug:
+                print("applyPlcSet: %s not connected, can not set %s." %(dev.upper(), str(devPlan[dev])))
+        if 'Mpwr' in parmDict: self.refreshLoadState()
+        return resultDict
+
 #--------------------------------------------------------------------------
     def setMainPwr(self, val):
         """ Set the system main power. 0-off, 1-on."""
-        self.autoCtrl = False 
-        pwrVal = 1 if val == 'on' else 0
-        ledVal = 0 if val == 'on' else 1
-        plc2Val = True if val == 'on' else False
-        if self.plc1.connected:
-            self.plc1.writeMem('M0', pwrVal)
-            time.sleep(0.1)
-            self.plc1.writeMem('M10', pwrVal)
-            time.sleep(0.1)
-            self.plc1.writeMem('M60', ledVal)
-            time.sleep(0.1) 
-        if self.plc2.connected:
-            self.plc2.writeMem('qx0.0', plc2Val)
-            time.sleep(0.1) 
-            self.plc2.writeMem('qx0.2', not plc2Val)
-            time.sleep(0.1)
-        if self.plc3.connected:
-            self.plc3.writeMem('M10', pwrVal)
-            time.sleep(0.1)
-            self.plc3.writeMem('M60', ledVal)
-            time.sleep(0.1)
-        return
-        # below is the one using new PLC lider diagram follow the function introduction.
-        if not self.plc3.connected:
-            print('PLC3 not connected, can not set system main power.')
-            return
-        self.plc3.writeMem('M6', pwrVal)
+        self.applyPlcSet({'Mpwr': val})
 
 #--------------------------------------------------------------------------
     def setMotoSpeed(self, val):
         """ Set generator pump speed plc2 [Q3, Q3]. FF-off, FT-low, TF-high."""
-        # change the plc state to do the action.
-        if not self.plc2.connected:
-            if self.debug: print('PLC2 not connected, can not set Moto speed.')
-            return
-        mSpeedDict = {'off': (False, False), 'low': (False, True), 'high': (True, False)}
-        self.plc2.writeMem('qx0.3', mSpeedDict[val][0])
-        time.sleep(0.01) # need we sleep a shot while for plc to response?
-        self.plc2.writeMem('qx0.4', mSpeedDict[val][1])
+        self.applyPlcSet({'Mspd': val})
 
 #--------------------------------------------------------------------------
     def setPumpSpeed(self, val):
         """ Set generator pump speed plc1 [M4, M5]. 00-off, 01-low, 10-high."""
-        if not self.plc1.connected:
-            if self.debug: print('PLC1 not connected, can not set pump speed.')
-            return
-        # change the plc state to do the action.
-        pSpeedDict = {'off': (0, 0), 'low': (0, 1), 'high': (1, 0)}
-        self.plc1.writeMem('M4', pSpeedDict[val][0])
-        time.sleep(0.01) # need we sleep a shot while for plc to response?
-        self.plc1.writeMem('M5', pSpeedDict[val][1])
+        self.applyPlcSet({'Pspd': val})
 
 #--------------------------------------------------------------------------
     def setSensorPwr(self, val):
         """ Set all track sensor's power PLC3 [M4, M5]. 00-off, 11-on."""
-        if not self.plc3.connected:
-            if self.debug: print('PLC3 not connected, can not set all sensor power.')
-            return
-        parm = 1 if val == 'on' else 0
-        self.plc3.writeMem('M4', parm)
-        self.plc3.writeMem('M5', parm)
+        self.applyPlcSet({'Spwr': val})
 
 #--------------------------------------------------------------------------
-    def setGenState(self, stateStr):
+    def setGenState(self, stateStr, priority=devDriver.PRI_OPER):
         """ Set the generator working state.
         Args:
             stateStr ([str]): generator state string:
             Freq:Volt:Fled:Vled:Mled:Pled:Smok:Sirn
             example: 52.00:11.00:amber:amber:amber:amber:off:on"
+            priority ([int]): serial actor request priority class.
         Returns:
             [None]: [description]
         """
         if self.serialComm and self.serialComm.connected:
-            self.serialComm.write(stateStr.encode('utf-8'))
+            self._devCall('gen', 'write', stateStr.encode('utf-8'), priority=priority)
         valList = stateStr.split(':')
         if len(valList) != 8:
             print("Error: serialComm str parameter missing: %s" %stateStr)
@@ -412,90 +589,155 @@ class pwrGenClient(object):
             self.stateMgr.updateGenSerState(genDict)
 
 #--------------------------------------------------------------------------
-    def startAttack(self, threadName):
-        """ Simulate the attack situation."""
-        self.atkLocker = True   # Lock the attack flag.
-        self.autoCtrl = False   # disable the auto control.
-        if threadName == 'A;1':
-            # Create the generator alert.
-            time.sleep(10)
-            self.setGenState("52.00:11.00:amber:amber:amber:amber:off:on")
-            time.sleep(5)
-            # Show the generator down situation.
-            self.setGenState("50.00:00.00:red:red:red:red:off:off")
-            self.autoCtrl = True
+    def startAttack(self, atkName):
+        """ Start playing the attack scenario timeline (ATK_SCN) on a runner 
+            thread, the PLC tasks are paused until the scenario ends.
+        """
+        if not self.scheduler.pause(): return None # other attack is running.
+        try:
+            scn = scenarioEng.loadScenario(ATK_SCN[atkName], flags=SCN_FLAGS)
+        except (KeyError, OSError, ValueError) as err:
+            print("startAttack: can not load the scenario %s: %s" %(atkName, str(err)))
+            self.scheduler.resume()
             return None
-        elif threadName == 'A;3':
-            time.sleep(5) # wait 5 sec then start the attack.
-            print(">>> Start the Stealthy attack.")
-            self.setGenState("49.89:11.00:red:red:red:red:off:on")
-            self.stSubAtkFlag = 1 # put the attack appearence after the module have action.
-            time.sleep(1)
-            if self.plc1.connected: self.plc1.writeMem('M60', 1)               
-            time.sleep(1)
-
-            for i in range(15):
-                val = i%2
-                # 1. Flickering of Airport runway light
-                if self.plc1.connected:
-                    self.plc1.writeMem('M0', val)
-                    time.sleep(0.3)
-                    self.plc1.writeMem('M10', val)
-                    time.sleep(0.3)
-                # 2. Flickering of substation light(optional)
-                if self.plc2.connected:
-                    v = True if val == 1 else False
-                    self.plc2.writeMem('qx0.0', v)
-                    time.sleep(0.3)
-                # 3.Train stop/start moving
-                if self.plc3.connected:
-                    self.plc3.writeMem('M10', 0)
-                    time.sleep(0.5)
-                    self.plc3.writeMem('M10', 1)
-                if i == 5:
-                    self.setGenState("50.80:11.00:red:red:red:red:off:off")
-                if i == 10:
-                    self.setGenState("50.00:11.00:amber:amber:amber:amber:off:on")
-
-            # 3.Switch off Airport runway light
-            self.plc1.writeMem('M10', 0)
-            # 4.Wait for 10 secs
-            time.sleep(10)
-            # Generater show alert
-            self.setGenState("51.20:11.00:red:red:red:red:off:off")
-            # 5. Switch off Train
-            self.plc3.writeMem('M10', 0)
-            # 6. Wait for 10 secs
-            time.sleep(10)
-            # self.plc2.writeMem('qx0.2', True)
-            # 7.City light change to red. 
-            self.plc3.writeMem('M60', 1)
-            # self.autoCtrl = True
-        self.atkLocker = False
+        self.atkRunner = scenarioEng.scenarioRunner(self, scn, self._runActions, 
+                                                    onFinish=self._atkFinished, debug=self.debug)
+        self.atkRunner.start()
         return None
 
+#--------------------------------------------------------------------------
+    def _atkFinished(self, runner):
+        """ Scenario runner end callback."""
+        if not runner.cancelled and runner.scn.resume: self.scheduler.resume()
+
+#--------------------------------------------------------------------------
+    def _runActions(self, actions):
+        """ Execute the actions of one scenario time slot: the actions of the
+            different devices run concurrently on the driver loop, the actions
+            of one device keep their order.
+        """
+        devActions = {}
+        for action in actions:
+            devActions.setdefault(action.dev, []).append(action)
+        results = self.ioLoop.runCoro(devDriver.gatherAll(
+            *[self._runDevActions(devList) for devList in devActions.values()])).result()
+        for result in results:
+            if isinstance(result, Exception): print("_runActions: action error: %s" %str(result))
+
+#--------------------------------------------------------------------------
+    async def _runDevActions(self, actions):
+        """ Execute the scenario actions of one device in order."""
+        for action in actions:
+            await self._runAction(action)
+
+#--------------------------------------------------------------------------
+    async def _runAction(self, action):
+        """ Execute one scenario action."""
+        if action.op == 'write':
+            # The drivers skip the write if the PLC is not connected.
+            drv = self.drivers[action.dev]
+            tag = S7_ADDR.get(action.tag, action.tag) if action.dev == 'plc2' else action.tag
+            await drv.write(tag, action.val, priority=devDriver.PRI_SCN)
+        elif action.op == 'state':
+            # The serial write and state update run on the loop's executor.
+            await asyncio.get_running_loop().run_in_executor(
+                None, partial(self.setGenState, action.val, priority=devDriver.PRI_SCN))
+        elif action.op == 'flag' and action.tag in SCN_FLAGS:
+            setattr(self, action.tag, action.val)
+        elif action.op == 'print':
+            print(action.val)
+        else:
+            print("_runAction: can not handle the action: %s" %str(action))
+
 #--------------------------------------------------------------------------
     def stopAttack(self):
         """ recover the PLC and power generator state after attack."""
+        self.scheduler.pause()
+        # Cancel the running scenario before the next time slot.
+        runner, self.atkRunner = self.atkRunner, None
+        if runner:
+            runner.cancel()
+            runner.join(ATK_STOP_TIMEOUT)
         # Recover the power generator
-        self.atkLocker = True
         self.setGenState("52.00:11.00:green:green:green:green:off:off")                
-        # Revocer the PLC state.
-        if self.plc1.connected:
-            self.plc1.writeMem('M0', 1)
-            self.plc1.writeMem('M10', 1)
-            self.plc1.writeMem('M60', 0)   
-        if self.plc2.connected:
-            self.plc2.writeMem('qx0.0', True)
-        if self.plc3.connected:
-            self.plc3.writeMem('M10', 1)
-        self.atkLocker = False
+        # Revocer the PLCs state concurrently.
+        recovery = self.ioLoop.runCoro(devDriver.gatherAll(
+            self.drivers['plc1'].batch({'M0': 1, 'M10': 1, 'M60': 0}),
+            self.drivers['plc2'].write(S7_ADDR['qx0.0'], True),
+            self.drivers['plc3'].write('M10', 1)))
+        for result in recovery.result():
+            if isinstance(result, Exception): print("stopAttack: PLC recover error: %s" %str(result))
+        self.refreshLoadState()
+        self.scheduler.resume()
         self.stSubAtkFlag = 0
 
+#--------------------------------------------------------------------------
+#--------------------------------------------------------------------------
+class loadDecoder(object):
+    """ Compiled load decoder: decode the raw PLC response bytes to a loads on 
+        bitmask (bit i is the i-th load in the decoder table).
+    """
+    def __init__(self, table):
+        self.loads = tuple(table.keys())
+        self.devTables = {}     # {device: ((load bit, byte offset, bit mask, inverse), ...)}
+        self.devLoads = {}      # {device: (load name, ...)}
+        for idx, (load, (device, offset, mask, polarity)) in enumerate(table.items()):
+            self.devTables.setdefault(device, []).append((1 << idx, offset, mask, not polarity))
+            self.devLoads[device] = self.devLoads.get(device, ()) + (load,)
+        self.devTables = {dev: tuple(items) for dev, items in self.devTables.items()}
+        self.devices = tuple(self.devTables.keys())
+
+    def decode(self, device, data):
+        """ Decode the device's raw data bytes, return the loads on bitmask."""
+        loadMask = 0
+        for loadBit, offset, mask, inverse in self.devTables[device]:
+            if bool(data[offset] & mask) != inverse: loadMask |= loadBit
+        return loadMask
+
+    def toDict(self, loadMask, device=None):
+        """ Convert the loads bitmask to the {load: 0/1} dict (only the loads of
+            the device if it is given).
+        """
+        loads = self.loads if device is None else self.devLoads[device]
+        return {load: (loadMask >> self.loads.index(load)) & 1 for load in loads}
+
+#--------------------------------------------------------------------------
+#--------------------------------------------------------------------------
+class plcSetPlanner(object):
+    """ SetPLC request planner: merge the PLC changes of all the parameters in
+        a request to one {tag: value} batch per device (the S7-1200 tags are 
+        replaced by their compiled S7_ADDR handles).
+    """
+    def __init__(self, table):
+        self.table = table
+
+    def plan(self, parmDict):
+        """ Return the {device: {tag: value}} plan of the request parameters, the
+            unknown parameters and values are ignored.
+        """
+        devPlan = {}
+        for parm, val in parmDict.items():
+            if parm not in self.table: continue
+            valMap = self.table[parm]
+            if parm in ('Mpwr', 'Spwr'): val = 'on' if val == 'on' else 'off'
+            if val not in valMap:
+                print("plcSetPlanner: un-expect %s value: %s" %(parm, str(val)))
+                continue
+            for device, valDict in valMap[val].items():
+                devDict = devPlan.setdefault(device, {})
+                for tag, tagVal in valDict.items():
+                    devDict[S7_ADDR.get(tag, tag) if device == 'plc2' else tag] = tagVal
+        return devPlan
+
 #--------------------------------------------------------------------------
 #--------------------------------------------------------------------------
 class stateManager(object):
-    """ Manager module to save the current system state.""" 
+    """ Manager module to save the current system state. The generator, load
+        and substation states are the 'gen', 'load' and 'sub' sections of a
+        versioned stateStore: the writers from the main loop, the UDP/TCP
+        handlers and the attack threads are serialized by its lock and the 
+        readers get consistent copy on write snapshots.
+    """ 
     def __init__(self):
         # Serial cmd str sequence.
         self.serialSqu = ('Freq', 'Volt', 'Fled', 'Vled', 'Mled', 'Pled', 'Smok', 'Sirn')
@@ -504,7 +746,7 @@ class stateManager(object):
         self.loadCSVParm(os.path.join(os.path.dirname(__file__), CSV_VAL))
         self.AtkFlag = False # The flag to identify whether fetch the attack data.
         # Generator state dictionary.
-        self.genDict = {    'Freq': '50.00',    # frequency (dd.dd)
+        genDict = {         'Freq': '50.00',    # frequency (dd.dd)
                             'Volt': '11.00',    # voltage (dd.dd)
                             'Fled': 'green',    # frequency led (green/amber/off)
                             'Vled': 'green',    # voltage led (green/amber/off)
@@ -519,7 +761,7 @@ class stateManager(object):
                             'Mode': 0           # control mode.
                         }
         # Power load state dictionary. 
-        self.loadDict = {   'Indu': 0,      # Industry area
+        loadDict = {        'Indu': 0,      # Industry area
                             'Airp': 1,      # Airport runway
                             'Resi': 0,      # Residential area
                             'Stat': 1,      # Stataion power
@@ -528,7 +770,7 @@ class stateManager(object):
                             'City': 0,      # City power
                          }
         # Substation memory dictrionary.
-        self.subMemDict = {
+        subMemDict = {
             'ff00': '0',    # FF00:Pkm
             'ff01': '0',    # FF01:Qkm
             'ff02': '0',    # FF02:Pmk
@@ -541,6 +783,19 @@ class stateManager(object):
             'ff09': '0',    # FF09:Vm
             'ff10': '0',    # Attack flag
         }
+        self.store = stateStore.stateStore({'gen': genDict, 'load': loadDict, 'sub': subMemDict})
+
+#--------------------------------------------------------------------------
+    # Read only snapshots of the state sections (update them by the update*()
+    # functions, the snapshot dicts must not be changed).
+    @property
+    def genDict(self): return self.store.snapshot('gen').data
+
+    @property
+    def loadDict(self): return self.store.snapshot('load').data
+
+    @property
+    def subMemDict(self): return self.store.snapshot('sub').data
 
 #--------------------------------------------------------------------------
     def printState(self):
@@ -569,7 +824,7 @@ class stateManager(object):
 #--------------------------------------------------------------------------
     def getGenInfo(self):
         """ Return the generator state json string."""
-        return json.dumps(self.genDict)
+        return self.store.toJson('gen')
 
 #--------------------------------------------------------------------------
     def getSubInfo(self,atkFlag=None):
@@ -577,14 +832,13 @@ class stateManager(object):
             atkFlag = 0/None : normal case 
             atkFlag = 1: attack started
         """
-        loadNum = 3 if TEST_MODE else sum(
-            (self.loadDict['Airp'], self.loadDict['Stat'], self.loadDict['TrkA']))
+        loadNum = 3 if TEST_MODE else self.getLoadNum(keyList=('Airp', 'Stat', 'TrkA'))
         valIdx = randint(0, 5) if atkFlag else randint(0, 18)
         statStr = 'Atk' if atkFlag else 'Nml'
-        for i in range(10):
-            self.subMemDict["ff{:02d}".format(i)] = self.subParms[statStr][loadNum][valIdx][i]
-        self.subMemDict["ff10"] = '0' if atkFlag else '1'
-        return json.dumps(self.subMemDict)
+        subDict = {"ff{:02d}".format(i): self.subParms[statStr][loadNum][valIdx][i] for i in range(10)}
+        subDict["ff10"] = '0' if atkFlag else '1'
+        self.store.update('sub', subDict)
+        return self.store.toJson('sub')
 
 #--------------------------------------------------------------------------
     def getModBusStr(self):
@@ -595,17 +849,18 @@ class stateManager(object):
 #--------------------------------------------------------------------------
     def getLoadInfo(self):
         """ Return the power load state json string."""
-        return json.dumps(self.loadDict)
+        return self.store.toJson('load')
 
 #--------------------------------------------------------------------------
     def getLoadNum(self, keyList=None):
         """ Return the number of loads """
+        loadDict = self.loadDict    # one snapshot for all the keys.
         if keyList is None:
-            return sum(self.loadDict.values())
+            return sum(loadDict.values())
         else:
             count = 0
             for key in keyList:
-                count+=self.loadDict[key]
+                count+=loadDict[key]
             return count
 
 #--------------------------------------------------------------------------
@@ -615,27 +870,29 @@ class stateManager(object):
         """
         # first time init setting.
         if changeDict is None:
-            return ':'.join([self.genDict[keyStr] for keyStr in self.serialSqu])
+            genDict = self.genDict
+            return ':'.join([genDict[keyStr] for keyStr in self.serialSqu])
         valList = []
         for keyStr in self.serialSqu:
             if keyStr in changeDict.keys():
-                self.genDict[keyStr] = changeDict[keyStr]
-                valList.append(self.genDict[keyStr])
+                valList.append(changeDict[keyStr])
             else:
                 valList.append('-') # append the ingore char if the value not change.
+        self.store.update('gen', {keyStr: changeDict[keyStr] for keyStr in self.serialSqu 
+                                  if keyStr in changeDict})
         return ':'.join(valList)
 
 #--------------------------------------------------------------------------
     def updateGenPlcState(self, changeDict):
         """ Update the generator PLC state."""
-        for keyStr in changeDict.keys():
-            self.genDict[keyStr] = changeDict[keyStr]
+        self.store.update('gen', changeDict)
 
 #--------------------------------------------------------------------------
     def updateLoadPlcState(self, changeDict):
-        """ Update the load PLc state. """
-        for keyStr in changeDict.keys():
-            self.loadDict[keyStr] = changeDict[keyStr]
+        """ Update the load PLc state as one new version of the 'load' section,
+            so a reader never sees a half updated load state.
+        """
+        self.store.update('load', changeDict)
 
 #--------------------------------------------------------------------------
 #--------------------------------------------------------------------------
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        scenarioEng.py
+#
+# Purpose:     This module provides the attack scenario engine: a scenario is a
+#              JSON timeline file with one track of actions per device, each
+#              action is at an absolute offset (sec) from the scenario start
+#              and a track can repeat a group of steps in a loop. All the tracks
+#              are merged into one sorted list of time slots and played by a
+#              runner thread on the monotonic clock, so the I/O time of an
+#              action doesn't delay the following ones. A run can be cancelled.
+#
+#              Scenario file example:
+#              {"name": "A;3", "resume": true,
+#               "tracks": {
+#                   "gen":  [{"at": 5, "op": "state", "val": "49.89:11.00:red:red:red:red:off:on"}],
+#                   "plc1": [{"at": 7, "loop": {"count": 15, "every": 1.4, "steps": [
+#                               {"at": 0, "op": "write", "tag": "M0", "val": [0, 1]}]}}]}}
+#              A list "val" in a loop step is cycled by the loop iteration index.
+#              The actions (op, device, PLC tag) are validated when the file is
+#              loaded, so a bad scenario is rejected before any action runs.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/09/26
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import os
+import json
+import time
+import threading
+from collections import namedtuple
+
+import loopSched
+import M2PLC221 as m221
+import S7PLC1200 as s71200
+
+SCN_DIR = os.path.join(os.path.dirname(__file__), 'scenarios') # scenario files folder.
+OFFSET_DIGITS = 6   # offsets are rounded to us so the equal slot times match.
+SCN_OPS = ('write', 'state', 'flag', 'print') # action operations.
+STATE_DEVS = ('gen',)   # devices taking the generator 'state' action.
+
+def m221Tag(tag):
+    """ Check the M221 coil tag, raise ValueError if it is unknown."""
+    if tag not in m221.MEM_ADDR: raise ValueError("unknown M221 tag: %s" % tag)
+    return tag
+
+# PLC devices taking the 'write' action and their tag check function (raise
+# ValueError if the tag is malformed).
+WRITE_DEVS = {'plc1': m221Tag, 'plc2': s71200.compileAddr, 'plc3': m221Tag}
+
+# One timeline action: the device <dev> executes <op> with the <tag> and <val>.
+scnAction = namedtuple('scnAction', ('offset', 'track', 'dev', 'op', 'tag', 'val'))
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class scenario(object):
+    """ Compiled scenario timeline. self.slots is the [(offset, [scnAction, ...])]
+        list sorted by the offset, the actions of one slot keep the order of
+        the tracks in the file. Raise ValueError if the timeline is malformed.
+    """
+    def __init__(self, scnDict):
+        self.name = scnDict.get('name', '')
+        self.resume = scnDict.get('resume', True) # resume the PLC tasks at the end.
+        actions = []
+        for track, steps in scnDict.get('tracks', {}).items():
+            actions.extend(self._compileSteps(track, steps, 0))
+        actions.sort(key=lambda action: action.offset)    # stable sort.
+        self.slots = []
+        for action in actions:
+            if self.slots and self.slots[-1][0] == action.offset:
+                self.slots[-1][1].append(action)
+            else:
+                self.slots.append((action.offset, [action]))
+        self.duration = self.slots[-1][0] if self.slots else 0
+
+#-----------------------------------------------------------------------------
+    def validate(self, flags=None):
+        """ Check the op, device and tag of all the actions, raise ValueError on
+            the first bad one. <flags> is the list of the allowed 'flag' tags 
+            (None: any).
+        """
+        for offset, actions in self.slots:
+            for action in actions:
+                err = None
+                if action.op not in SCN_OPS:
+                    err = "unknown op"
+                elif action.op == 'write':
+                    if action.dev not in WRITE_DEVS:
+                        err = "device can not be written"
+                    elif action.val is None:
+                        err = "write without value"
+                    else:
+                        try:
+                            WRITE_DEVS[action.dev](action.tag)
+                        except ValueError as exc:
+                            err = str(exc)
+                elif action.op == 'state':
+                    if action.dev not in STATE_DEVS or not isinstance(action.val, str):
+                        err = "state needs a gen device and a state string"
+                elif action.op == 'flag':
+                    if action.tag is None or (flags is not None and action.tag not in flags):
+                        err = "unknown flag"
+                if err: 
+                    raise ValueError("scenario %s @%s %s: %s" % (self.name, offset, tuple(action), err))
+
+#-----------------------------------------------------------------------------
+    def _compileSteps(self, track, steps, baseT, idx=None):
+        """ Expand the steps (and the loops) of a track to the action list."""
+        actions = []
+        for step in steps:
+            if 'at' not in step: raise ValueError("scenario %s: step without 'at': %s" % (self.name, step))
+            offset = baseT + float(step['at'])
+            if 'loop' in step:
+                loop = step['loop']
+                for i in range(int(loop.get('count', 1))):
+                    actions.extend(self._compileSteps(track, loop.get('steps', []),
+                                                      offset + i*float(loop.get('every', 0)), i))
+                continue
+            val = step.get('val')
+            if isinstance(val, list) and idx is not None: val = val[idx % len(val)]
+            actions.append(scnAction(round(offset, OFFSET_DIGITS), track, step.get('dev', track),
+                                     step.get('op', 'write'), step.get('tag'), val))
+        return actions
+
+#-----------------------------------------------------------------------------
+def loadScenario(path, flags=None):
+    """ Load, compile and validate the scenario file. <path> is a file path or
+        the file name in the SCN_DIR folder, <flags> the allowed 'flag' tags.
+        Raise ValueError if the scenario is malformed.
+    """
+    if not os.path.exists(path): path = os.path.join(SCN_DIR, path)
+    with open(path, 'r') as fh:
+        scn = scenario(json.load(fh))
+    scn.validate(flags)
+    return scn
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class scenarioRunner(threading.Thread):
+    """ Thread playing a scenario: each time slot's action list is passed to
+        dispatch(actions) at its offset from the start time, onFinish(runner)
+        is called when the run ends (check runner.cancelled).
+        init example: runner = scenarioRunner(None, loadScenario('atkA3.json'), print)
+    """
+    def __init__(self, parent, scn, dispatch, onFinish=None, debug=False):
+        threading.Thread.__init__(self, name='scenario %s' % scn.name, daemon=True)
+        self.parent = parent
+        self.scn = scn
+        self.dispatch = dispatch
+        self.onFinish = onFinish
+        self.debug = debug
+        self.terminate = threading.Event()
+        self.cancelled = False
+        self.lateness = loopSched.timeStats()  # slot dispatch time after its offset.
+
+#-----------------------------------------------------------------------------
+    def run(self):
+        """ Dispatch the time slots until the end or cancel() is called."""
+        startT = time.monotonic()
+        try:
+            for offset, actions in self.scn.slots:
+                # Wait on the absolute deadline: the earlier I/O time is absorbed.
+                if self.terminate.wait(max(0, startT + offset - time.monotonic())): break
+                self.lateness.add(time.monotonic() - startT - offset)
+                if self.debug: print("scenarioRunner %s @%.2f: %s" % (self.scn.name, offset, actions))
+                self.dispatch(actions)
+        finally:
+            self.cancelled = self.terminate.is_set()
+            if self.onFinish: self.onFinish(self)
+
+#-----------------------------------------------------------------------------
+    def cancel(self):
+        """ Stop the run before the next time slot."""
+        self.terminate.set()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        scn = loadScenario('atkA3.json')
+        print("Scenario %s: %s slots, %s sec." % (scn.name, len(scn.slots), scn.duration))
+        for offset, actions in scn.slots[:10]:
+            print(offset, [(a.dev, a.op, a.tag, a.val) for a in actions])
+        for bad in ({'at': 1, 'op': 'wirte', 'tag': 'M0', 'val': 1}, {'at': 1, 'tag': 'M99', 'val': 1}, 
+                    {'at': 1, 'dev': 'plc2', 'tag': 'qx0.9', 'val': 1}):
+            try:
+                scenario({'name': 'bad', 'tracks': {'plc1': [bad]}}).validate()
+            except ValueError as err:
+                print("rejected: %s" % err)
+    elif mode == 1:
+        print("Play a scenario with 50ms actions and cancel it after 2 sec:")
+        scn = scenario({'name': 'test', 'tracks': {'plc1': [{'at': 0, 'loop': {
+            'count': 10, 'every': 0.3, 'steps': [{'at': 0, 'tag': 'M0', 'val': [0, 1]}]}}]}})
+        runner = scenarioRunner(None, scn, lambda actions: time.sleep(0.05),
+                                onFinish=lambda r: print("cancelled: %s, lateness: %s"
+                                                         % (r.cancelled, r.lateness.toDict())))
+        runner.start()
+        time.sleep(2)
+        runner.cancel()
+        runner.join()
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)
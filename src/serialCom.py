@@ -39,6 +39,7 @@ class serialCom(Serial):
             windows device manager.   
         """
         self.connected = False
+        self.portList = []  # ports found by the automatic search.
         # Automatically find the serial port which can read and write.
         if serialPort is None:
             conIdx = 0  # port index used for connection.
@@ -61,6 +62,7 @@ class serialCom(Serial):
                     portList.append(port)
                 except (OSError, SerialException):
                     pass
+            self.portList = portList
             if len(portList) == 0:
                 print('serialCom: no COM port can be used for connection.')
                 return
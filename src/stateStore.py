@@ -0,0 +1,124 @@
+#!/usr/bin/python
+#-----------------------------------------------------------------------------
+# Name:        stateStore.py
+#
+# Purpose:     This module provides a thread safe state store used by the
+#              manager's stateManager. The state is split in named sections
+#              (such as the generator, the load and the substation state),
+#              each section has a version number which is increased by every
+#              change. The writes are serialized by a lock and are copy on
+#              write: a new dict is built and swapped in one assignment, so the
+#              readers (UDP/TCP handlers, the Modbus server, the historian)
+#              take a consistent snapshot without any lock and never see a
+#              half updated section. The JSON string of a section is cached
+#              per version.
+#
+# Author:      Yuancheng Liu
+#
+# Created:     2020/10/02
+# Copyright:   YC @ Singtel Cyber Security Research & Development Laboratory
+# License:     YC
+#-----------------------------------------------------------------------------
+import json
+import time
+import threading
+from collections import namedtuple
+
+# Immutable section snapshot: the <data> dict must be treated as read only.
+stateSnap = namedtuple('stateSnap', ('version', 'data'))
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+class stateStore(object):
+    """ Versioned copy on write state store.
+        init example: store = stateStore({'gen': {'Freq': '50.00'}})
+                      store.update('gen', {'Freq': '49.80'})
+                      snap = store.snapshot('gen') # snap.version, snap.data
+    """
+    def __init__(self, sections=None):
+        self.lock = threading.Lock()    # serializes the writers only.
+        self.sections = {}  # {name: stateSnap}, a snapshot is replaced, never changed.
+        self.jsonCache = {} # {name: (version, json string)}
+        for name, data in (sections or {}).items(): self.addSection(name, data)
+
+#-----------------------------------------------------------------------------
+    def addSection(self, name, data):
+        """ Add (or replace) a section with the initial data dict."""
+        with self.lock:
+            version = self.sections[name].version + 1 if name in self.sections else 0
+            self.sections[name] = stateSnap(version, dict(data))
+
+#-----------------------------------------------------------------------------
+    def snapshot(self, name):
+        """ Return the current stateSnap(version, data) of the section (no lock:
+            the section snapshot is swapped by one assignment).
+        """
+        return self.sections[name]
+
+    def get(self, name, key, default=None):
+        """ Return the value of one key in the section."""
+        return self.sections[name].data.get(key, default)
+
+    def version(self, name):
+        """ Return the current version number of the section."""
+        return self.sections[name].version
+
+    def getVersions(self):
+        """ Return the {section name: version} dict."""
+        return {name: snap.version for name, snap in self.sections.items()}
+
+#-----------------------------------------------------------------------------
+    def update(self, name, changeDict):
+        """ Apply the {key: val} changes to the section as one new version, a
+            write which changes nothing keeps the version. Return the version.
+        """
+        with self.lock:
+            snap = self.sections[name]
+            if all(key in snap.data and snap.data[key] == val for key, val in changeDict.items()):
+                return snap.version
+            data = dict(snap.data)
+            data.update(changeDict)
+            self.sections[name] = stateSnap(snap.version + 1, data)
+            return snap.version + 1
+
+#-----------------------------------------------------------------------------
+    def toJson(self, name):
+        """ Return the JSON string of the section, serialized once per version."""
+        snap = self.sections[name]
+        cached = self.jsonCache.get(name)
+        if cached and cached[0] == snap.version: return cached[1]
+        jsonStr = json.dumps(snap.data)
+        self.jsonCache[name] = (snap.version, jsonStr)
+        return jsonStr
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+def testCase(mode):
+    """ Module testCase function."""
+    if mode == 0:
+        print("2 writers and 2 readers for 1 sec, check torn reads:")
+        store = stateStore({'load': {'Indu': 0, 'Airp': 0, 'Resi': 0}})
+        terminate = threading.Event()
+        torn = []
+        def writer(val):
+            while not terminate.is_set():
+                store.update('load', {'Indu': val, 'Airp': val, 'Resi': val})
+        def reader():
+            while not terminate.is_set():
+                snap = store.snapshot('load')
+                if len(set(snap.data.values())) != 1: torn.append(snap)
+                json.loads(store.toJson('load'))
+        threads = [threading.Thread(target=writer, args=(0,)), threading.Thread(target=writer, args=(1,)),
+                   threading.Thread(target=reader), threading.Thread(target=reader)]
+        for thread in threads: thread.start()
+        time.sleep(1)
+        terminate.set()
+        for thread in threads: thread.join()
+        print("versions: %s, torn reads: %s" % (store.getVersions(), len(torn)))
+    else:
+        # Add more test case here and use <mode> flag to select.
+        pass
+
+#-----------------------------------------------------------------------------
+if __name__ == '__main__':
+    testCase(0)